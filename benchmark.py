@@ -0,0 +1,373 @@
+"""
+Benchmarks of the data loading, kernel, S-K training and scoring paths.
+
+Cards are synthesized with zener_generator at each requested size and
+every stage is timed on them (best of --repeat runs). The results, with
+throughputs, go to a JSON report; given a baseline report, every stage is
+compared against it and slowdowns beyond the tolerance are flagged.
+
+Stages:
+    generate      zener_generator.generate_batch
+    rep_data      utils.rep_data on a sample of PNG cards (--png-sample)
+    read_folder   card_cache.read_folder on the same PNG cards
+    init_data     sk_train.init_data from a .npz shard (load, lambda & scaling)
+    calc_lambda   sk_train.calc_lambda
+    sk_steps      --sk-steps iterations of sk_train.sk_algorithm
+    score         svm_model_tester.score_batch on every card
+    conv_epoch    one epoch of conv_train.Net (skipped without torch)
+
+Usage:
+    python benchmark.py --sizes 1000 10000 100000 --output bench.json [--baseline old.json]
+
+:authors Jason, Nick, Sam
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import card_cache
+import sk_train
+from svm_model import compact_model
+from svm_model_tester import score_batch
+from training_monitor import max_rss_mb
+from utils import rep_data
+from zener_generator import CHUNK_SIZE, generate_batch, generate_chunk, save_shard
+
+
+REPORT_FORMAT = 'sk-benchmark'
+STAGES = ('generate', 'rep_data', 'read_folder', 'init_data', 'calc_lambda', 'sk_steps', 'score', 'conv_epoch')
+
+
+class Skipped(Exception):
+    """
+    Raised by a stage that cannot run here (e.g. a missing optional package).
+    """
+
+
+def timed(func, repeat=1):
+    """
+    :param func: the function to time, called without arguments
+    :param repeat: how many times to run it
+    :returns type tuple: the best wall-clock time in seconds, the result of the last run
+    """
+    best = None
+    for _ in range(max(1, repeat)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best, result
+
+
+def train_args(args, shard, steps):
+    """
+    :param args: the CLARGS of the benchmark
+    :param shard: the .npz shard of cards
+    :param steps: training steps
+    :returns: sk_train CLARGS for a run on the shard
+    """
+    return sk_train.parser.parse_args([
+        '0', str(steps), args.class_letter, os.devnull, shard,
+        '--kernel-storage', args.kernel_storage,
+        '--kernel', args.kernel
+    ])
+
+
+def conv_epoch(pixels, labels, batch_size=64):
+    """
+    Train conv_train.Net for one epoch over the cards.
+
+    :param pixels: (n x 625) uint8 cards
+    :param labels: ord() of the letter of every card
+    :param batch_size: cards per SGD step
+    """
+    try:
+        import torch
+        import torch.nn.functional as F
+        from conv_train import Net
+    except ImportError as e:
+        raise Skipped(str(e))
+
+    torch.manual_seed(1)
+    X = torch.from_numpy(pixels.reshape(-1, 1, 25, 25)).float().div_(255)
+    y = torch.from_numpy(np.searchsorted(np.unique(labels), labels)).long()
+
+    model = Net()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.5)
+    model.train()
+    for start in range(0, len(X), batch_size):
+        optimizer.zero_grad()
+        loss = F.nll_loss(model(X[start:start + batch_size]), y[start:start + batch_size])
+        loss.backward()
+        optimizer.step()
+
+
+def bench_size(n, args, workdir):
+    """
+    Run every selected stage on n generated cards.
+
+    :param n: the number of cards
+    :param args: the CLARGS of the benchmark
+    :param workdir: folder for the temporary card files
+    :returns type dict: stage -> {'seconds', 'items', 'per_second'} (or {'error'} / {'skipped'})
+    """
+    results = {}
+
+    def run(stage, func, items):
+        if stage not in args.stages:
+            return None
+        try:
+            seconds, result = timed(func, args.repeat)
+        except Skipped as e:
+            results[stage] = {'skipped': str(e)}
+            print('  {:<12} skipped: {}'.format(stage, e))
+            return None
+        except Exception as e:
+            results[stage] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            print('  {:<12} failed: {}'.format(stage, results[stage]['error']))
+            return None
+
+        results[stage] = {
+            'seconds': seconds,
+            'items': items,
+            'per_second': items / seconds if seconds > 0 else None
+        }
+        print('  {:<12} {:>10.4f}s  {:>14,.0f} /s'.format(stage, seconds, results[stage]['per_second'] or 0))
+        return result
+
+    # Cards, generated (timed) once & reused by every stage
+    cards = run('generate', lambda: generate_batch(n, args.seed, args.workers), n)
+    if cards is None:
+        # Stage not selected (or failed): generate untimed
+        cards = generate_batch(n, args.seed, args.workers)
+    pixels, labels, indices = cards
+    shard = os.path.join(workdir, 'cards_{}.npz'.format(n))
+    save_shard(shard, pixels, labels, indices)
+
+    # PNG loading, on a sample of cards
+    m = min(n, args.png_sample)
+    if {'rep_data', 'read_folder'} & set(args.stages):
+        folder = os.path.join(workdir, 'cards_{}'.format(n))
+        os.makedirs(folder)
+        for chunk in range(int(math.ceil(float(m) / CHUNK_SIZE))):
+            generate_chunk(folder, chunk, m, args.seed)
+        files = [os.path.join(folder, f) for f in os.listdir(folder)]
+
+        run('rep_data', lambda: [rep_data(f) for f in files], m)
+        run('read_folder', lambda: card_cache.read_folder(folder), m)
+        shutil.rmtree(folder)
+
+    # S-K training
+    sk_args = train_args(args, shard, args.sk_steps)
+    input_data = run('init_data', lambda: sk_train.init_data(sk_args), n)
+
+    is_plus = labels == ord(args.class_letter)
+    X_plus, X_minus = pixels[is_plus] / 255, pixels[~is_plus] / 255
+    run('calc_lambda', lambda: sk_train.calc_lambda(X_plus, X_minus), n)
+    X_plus = X_minus = None
+
+    if {'sk_steps', 'score'} & set(args.stages):
+        if input_data is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                input_data = sk_train.init_data(sk_args)
+        params = run('sk_steps', lambda: sk_train.sk_algorithm(input_data, sk_args), args.sk_steps)
+        if params is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                params = sk_train.sk_algorithm(input_data, sk_args)
+
+        arrays, meta = compact_model(params, input_data)
+        model = dict(arrays)
+        model.update(meta)
+        run('score', lambda: score_batch(model, pixels / 255), n)
+
+    input_data = None
+    run('conv_epoch', lambda: conv_epoch(pixels, labels), n)
+
+    return results
+
+
+def environment():
+    """
+    :returns type dict: what the numbers were measured on
+    """
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compare every stage against a baseline report.
+
+    :param report: the benchmark report
+    :param baseline: an earlier benchmark report
+    :param tolerance: the fraction a stage may slow down before it is a regression
+    :returns type list: a dict per stage measured in both: size, stage, seconds, baseline_s, speedup, regression
+    """
+    rows = []
+    for size, stages in report['results'].items():
+        for stage, result in stages.items():
+            base = baseline.get('results', {}).get(size, {}).get(stage, {})
+            if 'seconds' not in result or 'seconds' not in base:
+                continue
+            speedup = base['seconds'] / result['seconds'] if result['seconds'] > 0 else float('inf')
+            rows.append({
+                'size': size,
+                'stage': stage,
+                'seconds': result['seconds'],
+                'baseline_s': base['seconds'],
+                'speedup': speedup,
+                'regression': speedup < 1 - tolerance
+            })
+
+    return rows
+
+
+# CLARGS
+parser = argparse.ArgumentParser(
+    description='Benchmark data loading, kernel, S-K training and scoring.',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog='For further questions, please consult the README.'
+)
+
+parser.add_argument(
+    '--sizes',
+    type=int,
+    nargs='+',
+    default=[1000, 10000],
+    help='Numbers of cards to benchmark with (default: 1000 10000).'
+)
+parser.add_argument(
+    '--stages',
+    nargs='+',
+    choices=STAGES,
+    default=list(STAGES),
+    help='Stages to run (default: all).'
+)
+parser.add_argument(
+    '--output',
+    default='benchmark.json',
+    help='JSON report to write (default: benchmark.json).'
+)
+parser.add_argument(
+    '--baseline',
+    default=None,
+    help='Earlier JSON report to compare against.'
+)
+parser.add_argument(
+    '--tolerance',
+    type=float,
+    default=0.1,
+    help='Fraction a stage may slow down against the baseline before it is a regression (default: 0.1).'
+)
+parser.add_argument(
+    '--fail-on-regression',
+    action='store_true',
+    default=False,
+    help='Exit with status 1 if any stage regressed.'
+)
+parser.add_argument(
+    '--repeat',
+    type=int,
+    default=3,
+    help='Runs of each stage; the best time is kept (default: 3).'
+)
+parser.add_argument(
+    '--sk-steps',
+    type=int,
+    default=1000,
+    help='S-K training steps to time (default: 1000).'
+)
+parser.add_argument(
+    '--png-sample',
+    type=int,
+    default=1000,
+    help='Most PNG cards written for the rep_data & read_folder stages (default: 1000).'
+)
+parser.add_argument(
+    '--class-letter',
+    default='W',
+    help='Class to train the SVM on (default: W).'
+)
+parser.add_argument(
+    '--kernel',
+    default='poly',
+    help='Kernel of the SVM (default: poly).'
+)
+parser.add_argument(
+    '--kernel-storage',
+    default='lru',
+    help='Kernel storage of the SVM, see sk_train.py (default: lru, which scales to any size).'
+)
+parser.add_argument(
+    '--seed',
+    type=int,
+    default=0,
+    help='Seed for the generated cards (default: 0).'
+)
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=os.cpu_count(),
+    help='Processes generating cards (default: all cores).'
+)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.class_letter = args.class_letter.upper()
+
+    report = {
+        'format': REPORT_FORMAT,
+        'environment': environment(),
+        'config': {key: getattr(args, key) for key in (
+            'stages', 'repeat', 'sk_steps', 'png_sample', 'class_letter', 'kernel', 'kernel_storage', 'seed')},
+        'results': {}
+    }
+
+    workdir = tempfile.mkdtemp(prefix='sk_bench_')
+    try:
+        for n in args.sizes:
+            print('{} cards'.format(n))
+            report['results'][str(n)] = bench_size(n, args, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    report['max_rss_mb'] = max_rss_mb()
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['comparison'] = compare(report, baseline, args.tolerance)
+
+        print('\nAgainst {}:'.format(args.baseline))
+        for row in report['comparison']:
+            print('  {:>8} {:<12} {:>8.3f}x{}'.format(
+                row['size'], row['stage'], row['speedup'], '  REGRESSION' if row['regression'] else ''))
+        regressions = [row for row in report['comparison'] if row['regression']]
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report saved to {}'.format(args.output))
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
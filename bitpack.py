@@ -0,0 +1,180 @@
+"""
+Bit-packed binary cards.
+
+Generated cards are black & white, so each one packs into 625 bits, i.e.
+ten uint64 words (80 bytes, vs 5000 bytes as float64). The dot product of
+two 0/1 cards is the popcount of their AND, so the linear Gram matrix
+G = X X^T, from which kernel_matrix.ScaledGram derives the kernel of the
+lambda-scaled cards, never needs the cards unpacked.
+
+:authors Jason, Nick, Sam
+"""
+
+import numpy as np
+
+from hull_stats import HullStats
+from image_loader import CARD_PIXELS
+
+
+WORD_BITS = 64
+
+# Set bits of every byte, for numpy without bitwise_count
+_POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """
+    :param words: uint64 array, words along the last axis
+    :returns numpy array: the number of set bits along the last axis, as int64
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+
+    counts = _POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)]
+    return counts.sum(axis=-1, dtype=np.int64)
+
+
+def is_binary(pixels):
+    """
+    :param pixels: uint8 card pixels
+    :returns type bool: True if every pixel is black (0) or white (255); otherwise, False
+    """
+    pixels = np.asarray(pixels)
+    return bool(np.all((pixels == 0) | (pixels == 255)))
+
+
+def pack_cards(pixels):
+    """
+    :param pixels: (n x d) uint8 binary cards (see is_binary)
+    :returns numpy array: (n x ceil(d / 64)) uint64 words, a set bit for every white pixel
+    """
+    pixels = np.asarray(pixels)
+    n, d = pixels.shape
+    n_words = -(-d // WORD_BITS)
+
+    packed = np.zeros((n, n_words * 8), dtype=np.uint8)
+    packed[:, :-(-d // 8)] = np.packbits(pixels > 127, axis=1)
+
+    return packed.view(np.uint64)
+
+
+def unpack_cards(words, n_pixels=CARD_PIXELS, dtype=np.float64):
+    """
+    :param words: (n x w) uint64 words from pack_cards
+    :param n_pixels: pixels per card
+    :param dtype: dtype of the result
+    :returns numpy array: (n x n_pixels) matrix of 1's for white; 0's otherwise
+    """
+    bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1, count=n_pixels)
+    return bits.astype(dtype, copy=False)
+
+
+class PackedCards(object):
+    """
+    Binary cards normalized to 0/1, bit-packed one card per row.
+
+    Stands in both for the (n x d) input matrix X (dot, unpack) and for its
+    linear Gram matrix G = X X^T (row lookup, diagonal), like
+    kernel_matrix.LinearRows, so it can be handed to ScaledGram as both.
+    """
+
+    def __init__(self, words, n_pixels=CARD_PIXELS, dtype=np.float64, block_size=4096):
+        """
+        :param words: (n x w) uint64 words from pack_cards
+        :param n_pixels: pixels per card
+        :param dtype: dtype of the rows & products handed out (float64 or float32)
+        :param block_size: cards unpacked at a time by dot
+        """
+        self.words = words
+        self.n_pixels = n_pixels
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+
+    @classmethod
+    def from_pixels(cls, pixels, dtype=np.float64):
+        """
+        :param pixels: (n x d) uint8 binary cards
+        :param dtype: see __init__
+        :returns type PackedCards: the packed cards
+        """
+        if not is_binary(pixels):
+            raise Exception('Cards are not binary (black & white only); they cannot be bit-packed')
+
+        return cls(pack_cards(pixels), np.shape(pixels)[1], dtype)
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self), self.n_pixels)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def unpack(self, rows=slice(None)):
+        """
+        :param rows: the cards to unpack (all by default)
+        :returns numpy array: the cards as a matrix of 1's for white; 0's otherwise
+        """
+        return unpack_cards(self.words[rows], self.n_pixels, self.dtype)
+
+    def dot(self, M):
+        """
+        :param M: (d x k) matrix
+        :returns numpy array: the (n x k) matrix X M, unpacking block_size cards at a time
+        """
+        M = np.asarray(M)
+        out = np.empty((len(self),) + M.shape[1:], dtype=np.result_type(self.dtype, M.dtype))
+        for start in range(0, len(self), self.block_size):
+            stop = min(start + self.block_size, len(self))
+            out[start:stop] = np.dot(self.unpack(slice(start, stop)), M)
+
+        return out
+
+    def __getitem__(self, k):
+        """
+        :param k: the index of a card
+        :returns numpy array: row k of G, i.e. x_k . x for every card x
+        """
+        return popcount(self.words & self.words[k]).astype(self.dtype)
+
+    def diagonal(self):
+        """
+        :returns numpy array: |x|^2 of every card
+        """
+        return popcount(self.words).astype(np.float64)
+
+    def hull_stats(self, is_plus):
+        """
+        Exact hull statistics of the cards split by a mask (see
+        hull_stats.split_hull_stats), without unpacking more than a block.
+
+        :param is_plus: boolean mask of the positive examples
+        :returns type HullStats: the statistics of both classes
+        """
+        is_plus = np.asarray(is_plus, dtype=bool)
+        W = np.stack((is_plus, ~is_plus), axis=1).astype(np.float64)
+
+        stats = HullStats(dim=self.n_pixels)
+        stats.n_plus = int(is_plus.sum())
+        stats.n_minus = len(is_plus) - stats.n_plus
+        stats.sum_plus = np.zeros(self.n_pixels, dtype=np.float64)
+        stats.sum_minus = np.zeros(self.n_pixels, dtype=np.float64)
+        for start in range(0, len(self), self.block_size):
+            stop = min(start + self.block_size, len(self))
+            sums = np.dot(W[start:stop].T, self.unpack(slice(start, stop)))
+            stats.sum_plus += sums[0]
+            stats.sum_minus += sums[1]
+
+        # |x - m|^2 = |x|^2 - 2 x.m + |m|^2 for the centroid m of each class
+        M = np.array([stats.m_plus, stats.m_minus])
+        P = self.dot(M.T)
+        sq_norms = self.diagonal()
+        for s, (mask, attr) in enumerate(((is_plus, 'r_plus'), (~is_plus, 'r_minus'))):
+            if mask.any():
+                sq_dist = sq_norms[mask] - 2 * P[mask, s] + np.dot(M[s], M[s])
+                setattr(stats, attr, float(np.sqrt(max(sq_dist.max(), 0))))
+
+        return stats
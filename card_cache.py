@@ -0,0 +1,171 @@
+"""
+Binary cache of a Zener card folder.
+
+Packs every '<index>_<letter>.png' card of a folder into a single
+memory-mappable file (see packed.py) holding:
+    pixels  -- (n x 625) uint8 matrix, one card per row
+    labels  -- (n,) uint8 ord() of the card letter
+    indices -- (n,) int64 index from the file name
+sorted by index. The header records the folder's mtime (or a content hash)
+so a stale cache is never used.
+
+Usage:
+    python card_cache.py train_folder [--output FILE] [--hash]
+
+:authors Jason, Nick, Sam
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from image_loader import CARD_SIZE, load_folder
+from packed import is_packed, read_packed, write_packed
+
+
+CACHE_EXT = '.zcache'
+
+
+def cache_path(folder):
+    """
+    :param folder: the card folder
+    :returns type str: the default cache file, stored next to the folder
+    """
+    return os.path.normpath(folder) + CACHE_EXT
+
+
+def folder_hash(folder):
+    """
+    :param folder: the card folder
+    :returns type str: sha1 of the names & contents of every card in the folder
+    """
+    h = hashlib.sha1()
+    for img_path in sorted(glob.glob(os.path.join(folder, '*.png'))):
+        h.update(os.path.basename(img_path).encode('utf-8'))
+        with open(img_path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def folder_signature(folder, use_hash=False):
+    """
+    :param folder: the card folder
+    :param use_hash: if True, use a content hash (reads every file) instead of the mtime
+    :returns type dict: what a cache of this folder must match to be fresh
+    """
+    if use_hash:
+        return {'sha1': folder_hash(folder)}
+    return {'mtime_ns': os.stat(folder).st_mtime_ns}
+
+
+def read_folder(folder):
+    """
+    Decode every card in a folder (see image_loader.load_folder).
+
+    :param folder: the card folder
+    :returns type tuple: pixels, labels & indices arrays sorted by index
+    """
+    return load_folder(folder)
+
+
+def build_cache(folder, path=None, use_hash=False):
+    """
+    Pack a card folder into a cache file.
+
+    :param folder: the card folder
+    :param path: the cache file (default: see cache_path)
+    :param use_hash: if True, freshness is checked against a content hash
+    :returns type str: the path of the cache file
+    """
+    path = path or cache_path(folder)
+    sig = folder_signature(folder, use_hash)
+
+    pixels, labels, indices = read_folder(folder)
+
+    meta = {
+        'folder': os.path.abspath(folder),
+        'signature': sig,
+        'card_size': list(CARD_SIZE)
+    }
+    write_packed(path, {'pixels': pixels, 'labels': labels, 'indices': indices}, meta)
+
+    return path
+
+
+def open_cache(folder, path=None):
+    """
+    Open the cache of a card folder if it is up to date.
+
+    :param folder: the card folder
+    :param path: the cache file (default: see cache_path)
+    :returns type tuple: memory-mapped pixels, labels & indices; None if no fresh cache
+    """
+    path = path or cache_path(folder)
+    if not is_packed(path):
+        return None
+
+    arrays, meta = read_packed(path)
+    cached_sig = meta.get('signature', {})
+    if cached_sig != folder_signature(folder, 'sha1' in cached_sig):
+        print('Card cache {} is stale, rebuild it with card_cache.py'.format(path))
+        return None
+
+    return arrays['pixels'], arrays['labels'], arrays['indices']
+
+
+def load_cards(folder, path=None):
+    """
+    Load a card folder, from its cache if there is a fresh one.
+
+    A .npz shard written by zener_generator.py can be given instead of a folder.
+
+    :param folder: the card folder (or .npz shard)
+    :param path: the cache file (default: see cache_path)
+    :returns type tuple: pixels, labels & indices arrays sorted by index
+    """
+    if folder.endswith('.npz') and os.path.isfile(folder):
+        shard = np.load(folder)
+        return shard['pixels'], shard['labels'], shard['indices']
+
+    if not os.path.isdir(folder):
+        raise Exception('Card folder not found: {}'.format(folder))
+
+    cached = open_cache(folder, path)
+    if cached is not None:
+        return cached
+
+    return read_folder(folder)
+
+
+# CLARGS
+parser = argparse.ArgumentParser(
+    description='Pack a folder of Zener cards into a memory-mappable cache file.',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog='For further questions, please consult the README.'
+)
+
+parser.add_argument(
+    'folder_name',
+    help='The folder of card images to cache.'
+)
+parser.add_argument(
+    '--output',
+    default=None,
+    help='Cache file to write (default: <folder_name>' + CACHE_EXT + ').'
+)
+parser.add_argument(
+    '--hash',
+    action='store_true',
+    default=False,
+    help='Check freshness against a content hash instead of the folder mtime.'
+)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    path = build_cache(args.folder_name, args.output, args.hash)
+    print('Cached {} to {}'.format(args.folder_name, path))
@@ -0,0 +1,177 @@
+"""
+Periodic checkpoints of the S-K trainer state, so that a long run that is
+killed part way through can be resumed where it left off.
+
+A checkpoint is a packed array file (see packed.py) holding the alphas,
+D & E as float64 and A~C, the initial guesses and the step count in its
+metadata, so resuming continues bit-for-bit. It is written atomically;
+a crash while writing leaves the previous checkpoint in place.
+
+:authors Jason, Nick, Sam
+"""
+
+import os
+import time
+
+import numpy as np
+
+from packed import is_packed, read_packed, write_packed
+
+
+CHECKPOINT_FORMAT = 'sk-checkpoint'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_EXT = '.ckpt'
+
+
+def checkpoint_path(args, class_letter=None):
+    """
+    :param args: the CLARGS from user input
+    :param class_letter: the class being trained (one checkpoint per class with ALL)
+    :returns type str: the checkpoint file of the run
+    """
+    path = getattr(args, 'checkpoint', None) or args.model_file_name + CHECKPOINT_EXT
+    if class_letter is not None and args.class_letter.upper() == 'ALL':
+        path = '{}.{}'.format(path, class_letter)
+    return path
+
+
+def _fingerprint(input_data):
+    """
+    :param input_data: the dict of X's & I's being trained on
+    :returns type dict: what a checkpoint must match to be resumed on this data
+    """
+    return {
+        'class_letter': input_data.get('class_letter'),
+        'n_plus': len(input_data['I_plus']),
+        'n_minus': len(input_data['I_minus']),
+        'kernel': input_data.get('kernel'),
+        'dtype': input_data.get('dtype')
+    }
+
+
+def save_checkpoint(path, state, step, input_data):
+    """
+    Atomically write the trainer state.
+
+    :param path: the checkpoint file
+    :param state: the SKState
+    :param step: the number of training steps taken so far
+    :param input_data: the dict of X's & I's being trained on
+    """
+    arrays = {
+        'alpha_i': state.alpha_i,
+        'alpha_j': state.alpha_j,
+        'D': state.D,
+        'E': state.E,
+        'I_plus': np.asarray(state.I_plus).astype(np.int64),
+        'I_minus': np.asarray(state.I_minus).astype(np.int64)
+    }
+    meta = {
+        'format': CHECKPOINT_FORMAT,
+        'version': CHECKPOINT_VERSION,
+        'step': int(step),
+        'A': float(state.A),  # JSON floats round-trip exactly
+        'B': float(state.B),
+        'C': float(state.C),
+        'i': int(state.i),
+        'j': int(state.j),
+        'data': _fingerprint(input_data)
+    }
+
+    write_packed(path, arrays, meta)
+
+
+def load_checkpoint(path, input_data, state_cls):
+    """
+    Read the trainer state back, checking it belongs to the same training data.
+
+    :param path: the checkpoint file
+    :param input_data: the dict of X's & I's being trained on
+    :param state_cls: the class of the trainer state (sk_train.SKState)
+    :returns type tuple: the restored state, the number of training steps already taken
+    """
+    if not is_packed(path):
+        raise Exception('CAN\'T FIND CHECKPOINT FILE')
+
+    arrays, meta = read_packed(path, mmap=False)
+    if meta.get('format') != CHECKPOINT_FORMAT:
+        raise Exception('{} is not an S-K checkpoint'.format(path))
+    if meta.get('version', 0) > CHECKPOINT_VERSION:
+        raise Exception('Checkpoint version {} is not supported'.format(meta['version']))
+
+    I_plus = np.asarray(input_data['I_plus'])
+    I_minus = np.asarray(input_data['I_minus'])
+    if (meta['data'] != _fingerprint(input_data)
+            or not np.array_equal(arrays['I_plus'], I_plus.astype(np.int64))
+            or not np.array_equal(arrays['I_minus'], I_minus.astype(np.int64))):
+        raise Exception('Checkpoint {} was made on different training data'.format(path))
+
+    state = state_cls(
+        arrays['alpha_i'].copy(), arrays['alpha_j'].copy(),
+        meta['A'], meta['B'], meta['C'],
+        arrays['D'].copy(), arrays['E'].copy(),
+        I_plus, I_minus,
+        i=meta['i'], j=meta['j']
+    )
+
+    return state, meta['step']
+
+
+class Checkpointer(object):
+    """
+    Decides when the trainer state is due to be saved: every `every` steps
+    and/or every `seconds` seconds. With neither set, it never saves.
+    """
+
+    def __init__(self, path, every=0, seconds=0):
+        """
+        :param path: the checkpoint file
+        :param every: save every this many steps (0 to disable)
+        :param seconds: save when this many seconds have passed since the last save (0 to disable)
+        """
+        self.path = path
+        self.every = every
+        self.seconds = seconds
+        self.last = time.time()
+
+    @classmethod
+    def from_args(cls, args, class_letter=None):
+        """
+        :param args: the CLARGS from user input
+        :param class_letter: the class being trained
+        :returns type Checkpointer: the checkpointer of the run
+        """
+        return cls(
+            checkpoint_path(args, class_letter),
+            getattr(args, 'checkpoint_every', 0) or 0,
+            getattr(args, 'checkpoint_seconds', 0) or 0
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.every or self.seconds)
+
+    def maybe_save(self, state, step, input_data):
+        """
+        :param state: the SKState
+        :param step: the number of training steps taken so far
+        :param input_data: the dict of X's & I's being trained on
+        :returns type bool: True if a checkpoint was written; otherwise, False
+        """
+        if not self.enabled:
+            return False
+
+        due = self.every and step % self.every == 0
+        due = due or (self.seconds and time.time() - self.last >= self.seconds)
+        if not due:
+            return False
+
+        self.save(state, step, input_data)
+        return True
+
+    def save(self, state, step, input_data):
+        save_checkpoint(self.path, state, step, input_data)
+        self.last = time.time()
+
+    def exists(self):
+        return os.path.exists(self.path)
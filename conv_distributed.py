@@ -0,0 +1,178 @@
+"""
+Data-parallel CNN training on the CPU cores of one machine.
+
+Every worker process holds a replica of the Net and trains it on its own
+shard of each batch; torch.distributed (gloo backend) all-reduces the
+gradients, so the replicas stay identical and a step of N workers is the
+step of one process on the whole batch. The cards are loaded once, in
+shared memory, and every worker indexes into them (see
+conv_train.CardView). Each worker gets an equal share of the cores for
+its intra-op threads, so the workers do not oversubscribe them.
+
+scaling_report trains with 1, 2, 4, ... workers and reports the
+throughput and scaling efficiency, (cards/s with N workers) / (N x
+cards/s with one).
+
+:authors Jason, Nick, Sam
+"""
+
+import os
+import socket
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+
+from conv_train import CardView, Net, RANDOM_SEED, batch_loader, save_net, test, train
+
+
+def free_port():
+    """
+    :returns type int: a free TCP port on localhost, for the process group to rendezvous on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def threads_per_worker(world_size, threads=None):
+    """
+    :param world_size: the number of worker processes
+    :param threads: intra-op threads asked for (per worker), if any
+    :returns type int: the intra-op threads of each worker, an equal share of the cores by default
+    """
+    return threads or max(1, (os.cpu_count() or 1) // world_size)
+
+
+def epoch_shard(train_rows, epoch, rank, world_size, seed=RANDOM_SEED):
+    """
+    :param train_rows: the rows to train on
+    :param epoch: the epoch, which reshuffles the rows
+    :param rank: the worker
+    :param world_size: the number of workers
+    :param seed: seed of the shuffle, the same on every worker
+    :returns numpy array: the rows of the worker, in training order; all workers get as many
+    """
+    rows = np.random.RandomState(seed + epoch).permutation(train_rows)
+    per_worker = len(rows) // world_size
+    return rows[rank * per_worker:(rank + 1) * per_worker]
+
+
+def _worker(rank, world_size, port, dataset, train_rows, test_rows, args, threads, results):
+    torch.set_num_threads(threads)
+    dist.init_process_group(
+        'gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=world_size)
+    try:
+        # Same initial weights everywhere (DDP also broadcasts rank 0's)
+        torch.manual_seed(RANDOM_SEED)
+        model = DistributedDataParallel(Net(getattr(args, 'network', None)))
+        optimizer = optim.SGD(
+            model.parameters(),
+            lr=args.lr,
+            momentum=args.momentum,
+            weight_decay=0  # L2 penalty value
+        )
+
+        # Each worker takes its share of every batch
+        batch_size = max(1, args.batch_size // world_size)
+        test_loader = batch_loader(CardView(dataset, test_rows), args.test_batch_size)
+
+        seconds = 0.0
+        cards = 0
+        metrics = None
+        for epoch in range(1, args.max_updates + 1):
+            rows = epoch_shard(train_rows, epoch, rank, world_size)
+            train_loader = batch_loader(CardView(dataset, rows), batch_size, num_workers=args.num_workers)
+
+            dist.barrier()
+            start = time.perf_counter()
+            train(model, optimizer, epoch, train_loader, args, log=rank == 0)
+            dist.barrier()
+            seconds += time.perf_counter() - start
+            cards += len(rows) * world_size
+
+            if rank == 0 and len(test_rows):
+                metrics = test(model.module, test_loader, args)
+
+        if rank == 0:
+            if getattr(args, 'save', True):
+                save_net(model.module, args.model_file_name)
+            results.put({'seconds': seconds, 'cards': cards, 'metrics': metrics})
+    finally:
+        dist.destroy_process_group()
+
+
+def fit_distributed(dataset, train_rows, test_rows, args, world_size, threads=None):
+    """
+    Train a new Net with world_size worker processes; the first one tests
+    it after every epoch and saves it to args.model_file_name (unless
+    args.save is False).
+
+    :param dataset: the loaded ZenerDataset (tensor mode)
+    :param train_rows: the rows to train on
+    :param test_rows: the rows to test on
+    :param args: the CLARGS from user input
+    :param world_size: the number of worker processes
+    :param threads: intra-op threads per worker (see threads_per_worker)
+    :returns type dict: the training seconds, the cards trained on & the last test metrics
+    """
+    if dataset.mode != 'tensor':
+        raise Exception('Data-parallel training needs the tensor data mode')
+
+    # The workers index into the same cards instead of receiving copies
+    dataset.data.share_memory_()
+    dataset.targets.share_memory_()
+
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    mp.spawn(
+        _worker,
+        args=(world_size, free_port(), dataset, np.asarray(train_rows), np.asarray(test_rows), args,
+              threads_per_worker(world_size, threads), results),
+        nprocs=world_size,
+        join=True
+    )
+    return results.get()
+
+
+def scaling_report(dataset, train_rows, args, max_workers, threads=None):
+    """
+    Train with 1, 2, 4, ... up to max_workers workers (nothing saved or
+    tested) and compare their throughputs.
+
+    :param dataset: the loaded ZenerDataset (tensor mode)
+    :param train_rows: the rows to train on
+    :param args: the CLARGS from user input
+    :param max_workers: the most workers to try
+    :param threads: intra-op threads per worker (see threads_per_worker)
+    :returns type list: a dict per worker count: workers, threads, seconds, cards_per_second, speedup, efficiency
+    """
+    counts = sorted({min(2**k, max_workers) for k in range(max_workers.bit_length() + 1)})
+
+    save = getattr(args, 'save', True)
+    args.save = False
+    rows = []
+    try:
+        for world_size in counts:
+            result = fit_distributed(dataset, train_rows, [], args, world_size, threads)
+            cards_per_second = result['cards'] / result['seconds']
+            base = rows[0]['cards_per_second'] if rows else cards_per_second
+            rows.append({
+                'workers': world_size,
+                'threads': threads_per_worker(world_size, threads),
+                'seconds': result['seconds'],
+                'cards_per_second': cards_per_second,
+                'speedup': cards_per_second / base,
+                'efficiency': cards_per_second / base / world_size
+            })
+            print('{:>3} workers x {:>2} threads: {:>8.2f}s {:>10,.0f} cards/s  speedup {:.2f}x  efficiency {:.0%}'.format(
+                world_size, rows[-1]['threads'], result['seconds'], cards_per_second,
+                rows[-1]['speedup'], rows[-1]['efficiency']))
+    finally:
+        args.save = save
+
+    return rows
@@ -0,0 +1,196 @@
+"""
+Batched CPU inference with a CNN trained by conv_train.py.
+
+The model is loaded once, put in eval mode and run without autograd on
+large batches of cards, normalized a batch at a time from the uint8
+pixels so that memory stays bounded however many cards there are. A
+model can be exported as TorchScript (scripted, or traced with --trace,
+and frozen), which loads without conv_train.py and starts faster; either
+kind of file can be used for inference.
+
+Usage:
+    python conv_infer.py model.pt cards_folder [--batch-size 512] [--threads N] [--output predictions.csv]
+    python conv_infer.py model.pt --export model.ts [--trace]
+
+:authors Jason, Nick, Sam
+"""
+
+import argparse
+import time
+import zipfile
+
+import numpy as np
+import torch
+
+from card_cache import load_cards
+from conv_train import CLASS_LABELS, load_net, normalize_cards
+from image_loader import CARD_SIZE
+from zener_generator import generate_batch
+
+
+DEFAULT_BATCH_SIZE = 512
+
+
+def is_torchscript(path):
+    """
+    :param path: a model file
+    :returns type bool: True if the file is a TorchScript archive; otherwise, False
+    """
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('/constants.pkl') for name in archive.namelist())
+
+
+def export_script(model, path, trace=False):
+    """
+    Save a Net as frozen TorchScript.
+
+    :param model: the Net
+    :param path: the TorchScript file
+    :param trace: if True, trace the model on a batch of cards instead of scripting it
+    :returns: the frozen TorchScript module
+    """
+    model = model.eval()
+    if trace:
+        example = torch.zeros((1, 1) + CARD_SIZE)
+        scripted = torch.jit.trace(model, example)
+    else:
+        scripted = torch.jit.script(model)
+
+    scripted = torch.jit.freeze(scripted)
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+class CardClassifier(object):
+    """
+    A CNN kept warm for classifying batches of cards.
+    """
+
+    def __init__(self, model, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        :param model: the Net (or TorchScript module)
+        :param batch_size: cards per forward pass
+        """
+        self.model = model.eval()
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_file(cls, path, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        :param path: a model file from conv_train.py or export_script
+        :param batch_size: cards per forward pass
+        :returns type CardClassifier: the classifier
+        """
+        if is_torchscript(path):
+            return cls(torch.jit.load(path, map_location='cpu'), batch_size)
+        return cls(load_net(path), batch_size)
+
+    def predict(self, pixels):
+        """
+        :param pixels: (n x 625) uint8 cards
+        :returns numpy array: the predicted class (position in SHAPES) of every card
+        """
+        pixels = torch.from_numpy(np.ascontiguousarray(pixels))
+        predictions = np.empty(len(pixels), dtype=np.int64)
+
+        with torch.inference_mode():
+            for start in range(0, len(pixels), self.batch_size):
+                stop = min(start + self.batch_size, len(pixels))
+                output = self.model(normalize_cards(pixels[start:stop]))
+                predictions[start:stop] = output.argmax(1).numpy()
+
+        return predictions
+
+
+# CLARGS
+parser = argparse.ArgumentParser(
+    description='Batched CPU inference with a CNN trained by conv_train.py.',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog='For further questions, please consult the README.'
+)
+
+parser.add_argument(
+    'model_file_name',
+    help='Model file from conv_train.py (or a TorchScript export).'
+)
+parser.add_argument(
+    'cards',
+    nargs='?',
+    help='Folder (or .npz shard) of cards to classify.'
+)
+parser.add_argument(
+    '--generate',
+    type=int,
+    default=None,
+    metavar='N',
+    help='Classify N cards generated in memory instead.'
+)
+parser.add_argument(
+    '--batch-size',
+    type=int,
+    default=DEFAULT_BATCH_SIZE,
+    help='Cards per forward pass (default: {}).'.format(DEFAULT_BATCH_SIZE)
+)
+parser.add_argument(
+    '--threads',
+    type=int,
+    default=None,
+    help='Intra-op threads of torch (default: torch\'s choice).'
+)
+parser.add_argument(
+    '--output',
+    default=None,
+    help='CSV file of "index,letter" predictions.'
+)
+parser.add_argument(
+    '--export',
+    default=None,
+    metavar='PATH',
+    help='Save the model as frozen TorchScript to PATH.'
+)
+parser.add_argument(
+    '--trace',
+    action='store_true',
+    default=False,
+    help='Export by tracing instead of scripting.'
+)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    start = time.perf_counter()
+    classifier = CardClassifier.from_file(args.model_file_name, args.batch_size)
+    print('Model loaded in {:.3f}s'.format(time.perf_counter() - start))
+
+    if args.export is not None:
+        export_script(classifier.model, args.export, args.trace)
+        print('TorchScript saved to {}'.format(args.export))
+
+    if args.generate:
+        pixels, labels, indices = generate_batch(args.generate)
+    elif args.cards:
+        pixels, labels, indices = load_cards(args.cards)
+    else:
+        pixels = None
+
+    if pixels is not None:
+        start = time.perf_counter()
+        predictions = classifier.predict(pixels)
+        seconds = time.perf_counter() - start
+        print('Classified {} cards in {:.3f}s ({:,.0f} cards/s)'.format(
+            len(pixels), seconds, len(pixels) / seconds if seconds > 0 else float('inf')))
+
+        letters = CLASS_LABELS[predictions]
+        print('Fraction Correct: {}'.format(np.mean(letters == np.asarray(labels))))
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                for ind, letter in zip(indices, letters):
+                    f.write('{},{}\n'.format(ind, chr(letter)))
+            print('Predictions saved to {}'.format(args.output))
@@ -5,16 +5,21 @@ CNN for zener card classification.
 """
 
 import argparse
+import os
+import sys
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import BatchSampler, Dataset, DataLoader, RandomSampler, SequentialSampler
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import transforms
-from torch.autograd import Variable
 
-from utils import init_data
+from cross_validation import aggregate, k_folds, report, run_folds, train_test_split
+from image_loader import CARD_SIZE
+from utils import init_data, load_input_cards
+from zener_generator import SHAPES
 
 ##################################################################################################
 # CNN
@@ -23,71 +28,238 @@ from utils import init_data
 # Constants
 RANDOM_SEED = 1
 
+# Pixel normalization of the cards (after scaling to [0, 1])
+NORMALIZE_MEAN = 0.1307
+NORMALIZE_STD = 0.3081
+
+# ord() of the letter of each class; a card's target is its position here
+CLASS_LABELS = np.array([ord(shape) for shape in SHAPES])
+
+DATA_MODES = ('tensor', 'pil')
+DATA_DTYPES = {'float32': torch.float32, 'uint8': torch.uint8}
+
+
+# Layers of Net without a network description (see parse_network_description)
+DEFAULT_NETWORK = [[10, 5], [20, 5], [50]]
+
+POOL_SIZE = 2
+
+MODEL_FORMAT = 'zener-cnn'
+
 
 class Net(nn.Module):
-    def __init__(self):
+    """
+    CNN built from a network description (see parse_network_description):
+    conv + max pool layers, then fully connected ones, then one output per
+    class. The flatten size between them is worked out from the card size,
+    and every layer's output shape, parameters & FLOPs are kept in
+    self.layers (see network_report).
+    """
+
+    def __init__(self, description=None, n_classes=len(SHAPES), input_size=CARD_SIZE):
+        """
+        :param description: [feature maps, kernel size] per conv layer, [units] per fully connected layer
+        :param n_classes: the number of outputs
+        :param input_size: (height, width) of the cards
+        """
         super(Net, self).__init__()
-        self.conv1 = nn.Conv2d(1, 10, kernel_size=5)
-        self.conv2 = nn.Conv2d(10, 20, kernel_size=5)
-        self.conv2_drop = nn.Dropout2d()
-        self.fc1 = nn.Linear(320, 50)
-        self.fc2 = nn.Linear(50, 10)  # TODO change 10 to 4
+        description = DEFAULT_NETWORK if description is None else description
+        self.description = [list(spec) for spec in description]
+        self.n_classes = n_classes
+
+        self.layers = []
+        features = []
+        classifier = []
+        shape = (1,) + tuple(input_size)
+        for spec in description:
+            if len(spec) == 2:
+                if classifier:
+                    raise Exception('Conv layers must come before fully connected ones: {}'.format(spec))
+                maps, size = spec
+                c, h, w = shape
+                h, w = h - size + 1, w - size + 1
+                if h < POOL_SIZE or w < POOL_SIZE:
+                    raise Exception('Conv layer {} shrinks the {}x{} cards to nothing'.format(spec, *input_size))
+
+                features.append(nn.Conv2d(c, maps, kernel_size=size))
+                self._add('conv {}@{}x{}'.format(maps, size, size), (maps, h, w),
+                          features[-1], 2 * c * size * size * maps * h * w)
+                if len(self.layers) > 1:
+                    features.append(nn.Dropout2d())
+
+                shape = (maps, h // POOL_SIZE, w // POOL_SIZE)
+                features.extend([nn.MaxPool2d(POOL_SIZE), nn.ReLU()])
+                self._add('pool {}x{}'.format(POOL_SIZE, POOL_SIZE), shape, None,
+                          (POOL_SIZE * POOL_SIZE - 1) * int(np.prod(shape)))
+            elif len(spec) == 1:
+                units = spec[0]
+                classifier.extend([nn.Linear(int(np.prod(shape)), units), nn.ReLU(), nn.Dropout()])
+                self._add('fc {}'.format(units), (units,), classifier[-3], 2 * int(np.prod(shape)) * units)
+                shape = (units,)
+            else:
+                raise Exception('Bad network description line: {}'.format(spec))
+
+        classifier.append(nn.Linear(int(np.prod(shape)), n_classes))
+        self._add('fc {} (output)'.format(n_classes), (n_classes,), classifier[-1], 2 * int(np.prod(shape)) * n_classes)
+
+        self.features = nn.Sequential(*features)
+        self.classifier = nn.Sequential(*classifier)
+
+    def _add(self, name, shape, module, flops):
+        params = 0 if module is None else sum(p.numel() for p in module.parameters())
+        self.layers.append({'name': name, 'shape': shape, 'params': params, 'flops': flops})
 
     def forward(self, x):
-        x = F.relu(F.max_pool2d(self.conv1(x), 2))
-        x = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x)), 2))
-        x = x.view(-1, 320)
-        x = F.relu(self.fc1(x))
-        x = F.dropout(x, training=self.training)
-        x = self.fc2(x)
-        return F.log_softmax(x)
-
-
-def train(epoch, train_loader):
+        x = self.features(x)
+        x = torch.flatten(x, 1)
+        x = self.classifier(x)
+        return F.log_softmax(x, dim=1)
+
+
+def save_net(model, path):
+    """
+    Save the weights of a Net with what is needed to rebuild it.
+
+    :param model: the trained Net
+    :param path: the model file
+    """
+    torch.save({
+        'format': MODEL_FORMAT,
+        'description': model.description,
+        'n_classes': model.n_classes,
+        'classes': list(SHAPES),
+        'normalize': [NORMALIZE_MEAN, NORMALIZE_STD],
+        'state_dict': {name: value.cpu() for name, value in model.state_dict().items()}
+    }, path)
+
+
+def load_net(path):
+    """
+    :param path: a model file written by save_net
+    :returns type Net: the Net, in eval mode on the CPU
+    """
+    saved = torch.load(path, map_location='cpu', weights_only=True)
+    if not isinstance(saved, dict) or saved.get('format') != MODEL_FORMAT:
+        raise Exception('{} is not a CNN model file'.format(path))
+
+    model = Net(saved['description'], saved['n_classes'])
+    model.load_state_dict(saved['state_dict'])
+    return model.eval()
+
+
+def network_report(model):
+    """
+    :param model: a Net
+    :returns type str: a table of the output shape, parameters & FLOPs (per card) of every layer
+    """
+    lines = ['{:<20} {:>12} {:>10} {:>14}'.format('layer', 'output', 'params', 'FLOPs')]
+    for layer in model.layers:
+        lines.append('{:<20} {:>12} {:>10,} {:>14,}'.format(
+            layer['name'], 'x'.join(str(n) for n in layer['shape']), layer['params'], layer['flops']))
+    lines.append('{:<20} {:>12} {:>10,} {:>14,}'.format(
+        'total', '', sum(layer['params'] for layer in model.layers), sum(layer['flops'] for layer in model.layers)))
+
+    return '\n'.join(lines)
+
+
+def train(model, optimizer, epoch, train_loader, args, log=True):
     model.train()
     for batch_idx, (data, target) in enumerate(train_loader):
-        print(f'Data: {type(data)}')
-        print(f'Target: {type(target)}')
-        print(target)
         if args.cuda:
             data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
-        print(f'Data: {data}')
-        print(f'Target: {target}')
         optimizer.zero_grad()
         output = model(data)
         loss = F.nll_loss(output, target)
         loss.backward()
         optimizer.step()
-        if batch_idx % args.log_interval == 0:
+        if log and batch_idx % args.log_interval == 0:
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch, batch_idx * len(data), len(train_loader.dataset),
-                100. * batch_idx / len(train_loader), loss.data[0]))
+                100. * batch_idx / len(train_loader), loss.item()))
 
 
-def test(test_loader):
+def test(model, test_loader, args):
+    """
+    :returns type dict: the average loss & the accuracy on the test cards
+    """
     model.eval()
     test_loss = 0
     correct = 0
-    for data, target in test_loader:
-        if args.cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data, volatile=True), Variable(target)
-        output = model(data)
-        test_loss += F.nll_loss(output, target, size_average=False).data[0] # sum up batch loss
-        pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-        correct += pred.eq(target.data.view_as(pred)).cpu().sum()
+    with torch.no_grad():
+        for data, target in test_loader:
+            if args.cuda:
+                data, target = data.cuda(), target.cuda()
+            output = model(data)
+            test_loss += F.nll_loss(output, target, reduction='sum').item() # sum up batch loss
+            pred = output.max(1, keepdim=True)[1] # get the index of the max log-probability
+            correct += pred.eq(target.view_as(pred)).sum().item()
 
     test_loss /= len(test_loader.dataset)
     print('\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
         test_loss, correct, len(test_loader.dataset),
         100. * correct / len(test_loader.dataset)))
 
+    return {'loss': test_loss, 'accuracy': correct / float(len(test_loader.dataset))}
+
+
+def fit(dataset, train_rows, test_rows, args):
+    """
+    Train a new Net on some rows of the dataset, testing it on others after every epoch.
+
+    :param dataset: the loaded ZenerDataset
+    :param train_rows: the rows to train on
+    :param test_rows: the rows to test on
+    :param args: the CLARGS from user input
+    :returns type tuple: the trained Net & its metrics on the test rows after the last epoch (see test)
+    """
+    torch.manual_seed(RANDOM_SEED)
+    if args.cuda:
+        torch.cuda.manual_seed(RANDOM_SEED)
+    kwargs = {'num_workers': args.num_workers}
+    if args.cuda:
+        kwargs['pin_memory'] = True
+
+    # CNN setup
+    model = Net(getattr(args, 'network', None))
+    if args.cuda:
+        model.cuda()
+    optimizer = optim.SGD(
+        model.parameters(),
+        lr=args.lr,
+        momentum=args.momentum,
+        weight_decay=0  # L2 penalty value
+    )
+
+    train_loader = batch_loader(CardView(dataset, train_rows), args.batch_size, shuffle=True, **kwargs)
+    test_loader = batch_loader(CardView(dataset, test_rows), args.test_batch_size, **kwargs)
+
+    # Train & test per epoch
+    metrics = None
+    for epoch in range(1, args.max_updates + 1):
+        train(model, optimizer, epoch, train_loader, args)
+        metrics = test(model, test_loader, args)
+
+    return model, metrics
+
+
+def cnn_fold(data, train_rows, test_rows):
+    """
+    :param data: the loaded dataset, args & torch threads per fold (see cross_validation.run_folds)
+    :returns type dict: the test metrics of the fold
+    """
+    if data.get('threads'):
+        torch.set_num_threads(data['threads'])
+    return fit(data['dataset'], train_rows, test_rows, data['args'])[1]
+
+
 def parse_network_description(network_description):
     '''
     Parse the file containing the network description and return a set of number to be used when
     constructing CNN
 
+    One line per layer: "maps size" for a conv layer of maps feature maps with size x size
+    kernels (followed by a max pool), "units" for a fully connected layer. Blank lines are skipped.
+
     :param network_description: The path to the file containing the network description
     :return: A 2D list where each index is structured as: [#_layers feature_map] or [#_layers]
     '''
@@ -95,7 +267,8 @@ def parse_network_description(network_description):
     net_desc = []
     with open(network_description, 'r') as f:
         for line in f.read().splitlines():
-            net_desc.append([int(x) for x in line.split(' ')])
+            if line.strip():
+                net_desc.append([int(x) for x in line.split()])
 
     return net_desc
 
@@ -105,37 +278,86 @@ def parse_network_description(network_description):
 ##################################################################################################
 
 
+def class_targets(labels):
+    """
+    :param labels: ord() of the letter of every card
+    :returns numpy array: the target (position in SHAPES) of every card
+    """
+    return np.searchsorted(CLASS_LABELS, labels)
+
+
+def normalize_cards(pixels, dtype=torch.float32):
+    """
+    :param pixels: uint8 cards, as a tensor or numpy array
+    :param dtype: float32 to normalize; uint8 to keep the raw pixels
+    :returns tensor: the (n x 1 x 25 x 25) cards, one contiguous tensor
+    """
+    cards = torch.as_tensor(pixels).reshape(-1, 1, *CARD_SIZE)
+    if dtype == torch.uint8:
+        return cards.contiguous()
+
+    # Same as transforms.ToTensor & Normalize, for all cards at once
+    cards = cards.to(torch.float32)
+    return cards.div_(255).sub_(NORMALIZE_MEAN).div_(NORMALIZE_STD)
+
+
 class ZenerDataset(Dataset):
+    """
+    Zener cards & their targets (see class_targets).
+
+    In tensor mode, the cards are decoded & normalized once into a single
+    contiguous (n x 1 x 25 x 25) tensor, float32 or raw uint8 (normalized
+    per batch, a quarter of the memory), and indexing with a list of
+    indices returns a whole batch by slicing (see batch_loader). With
+    share_memory, the tensors are moved to shared memory, so DataLoader
+    workers use them without copying.
+
+    In pil mode, the cards are PIL images run through transform one at a time.
+
+    All the cards are loaded; train/test splits & folds are CardViews of
+    them (see cross_validation.py).
+    """
+
+    def __init__(self, args, transform=None, target_transform=None,
+                 mode='tensor', dtype=torch.float32, share_memory=False):
+        if mode not in DATA_MODES:
+            raise Exception('Unknown data mode: {}'.format(mode))
 
-    def __init__(self, args, train=True, k_fold=1, transform=None, target_transform=None):
         self.args = args
-        self.train = train
-        self.k_fold = k_fold  # split the training & test data    
         self.transform = transform
         self.target_transform = target_transform
-
-        input_data = init_data(args, as_PIL=True)
-
-        if self.train:
-            self.train_data = input_data['X_plus'] + input_data['X_minus']
-            self.train_labels = input_data['Y_plus'] + input_data['Y_minus']
+        self.mode = mode
+
+        if mode == 'tensor':
+            pixels, labels, _ = load_input_cards(args)
+            self.data = normalize_cards(pixels, dtype)
+            self.targets = torch.from_numpy(class_targets(labels))
+            if share_memory:
+                self.data.share_memory_()
+                self.targets.share_memory_()
+            print('Data inputs initialized')
         else:
-            self.test_data = input_data['X_plus'] + input_data['X_minus']
-            self.test_labels = input_data['Y_plus'] + input_data['Y_minus']
-
+            input_data = init_data(args, as_PIL=True)
+            self.data = input_data['X_plus'] + input_data['X_minus']
+            self.targets = class_targets(input_data['Y_plus'] + input_data['Y_minus']).tolist()
 
     def __getitem__(self, index):
         """
         Args:
-            index (int): Index
+            index (int): Index, or (tensor mode) a list of indices
 
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        if self.train:
-            img, target = self.train_data[index], self.train_labels[index]
-        else:
-            img, target = self.test_data[index], self.test_labels[index]
+        if self.mode == 'tensor':
+            if not isinstance(index, int):
+                index = torch.as_tensor(index)
+            img, target = self.data[index], self.targets[index]
+            if img.dtype == torch.uint8:
+                img = normalize_cards(img).view(img.shape)
+            return img, target
+
+        img, target = self.data[index], self.targets[index]
 
         if self.transform is not None:
             img = self.transform(img)
@@ -146,10 +368,42 @@ class ZenerDataset(Dataset):
         return img, target
 
     def __len__(self):
-        if self.train:
-            return len(self.train_data)
-        else:
-            return len(self.test_data)
+        return len(self.data)
+
+
+class CardView(Dataset):
+    """
+    Some rows of a ZenerDataset (e.g. one side of a split), indexing into
+    its cards rather than copying them.
+    """
+
+    def __init__(self, dataset, rows):
+        self.dataset = dataset
+        self.rows = torch.as_tensor(np.asarray(rows), dtype=torch.long)
+        self.mode = dataset.mode
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            return self.dataset[int(self.rows[index])]
+        return self.dataset[self.rows[torch.as_tensor(index)]]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def batch_loader(dataset, batch_size, shuffle=False, **kwargs):
+    """
+    :param dataset: a ZenerDataset (or CardView)
+    :param batch_size: cards per batch
+    :param shuffle: if True, reshuffle the cards every epoch
+    :param kwargs: further DataLoader arguments (num_workers, pin_memory, ...)
+    :returns DataLoader: the batches; in tensor mode, each is one slice of the dataset (no per-card calls or collation)
+    """
+    if dataset.mode != 'tensor':
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False), **kwargs)
 
 
 ##################################################################################################
@@ -174,6 +428,35 @@ parser.add_argument('--no-cuda', action='store_true', default=False,
                     help='disables CUDA training')
 parser.add_argument('--log-interval', type=int, default=10, metavar='N',
                     help='how many batches to wait before logging training status')
+parser.add_argument('--data-mode', choices=DATA_MODES, default='tensor',
+                    help='tensor: decode & normalize all cards once into one tensor; '
+                         'pil: transform PIL images one at a time (default: tensor)')
+parser.add_argument('--data-dtype', choices=sorted(DATA_DTYPES), default='float32',
+                    help='dtype of the card tensor; uint8 is normalized per batch (default: float32)')
+parser.add_argument('--num-workers', type=int, default=0, metavar='N',
+                    help='DataLoader worker processes (default: 0)')
+parser.add_argument('--share-memory', action='store_true', default=False,
+                    help='put the card tensor in shared memory, for DataLoader workers')
+parser.add_argument('--test-fraction', type=float, default=0.2, metavar='F',
+                    help='fraction of every class held out for testing (default: 0.2)')
+parser.add_argument('--k-fold', type=int, default=0, metavar='K',
+                    help='report K-fold cross-validated metrics instead (the cards are loaded once)')
+parser.add_argument('--split-seed', type=int, default=None, metavar='S',
+                    help='seed for the train/test split & folds (default: unseeded)')
+parser.add_argument('--fold-workers', type=int, default=1, metavar='N',
+                    help='processes running folds in parallel with --k-fold (default: 1)')
+parser.add_argument('--ddp-workers', type=int, default=1, metavar='N',
+                    help='data-parallel training processes, all-reducing gradients over gloo (default: 1)')
+parser.add_argument('--threads', type=int, default=None, metavar='N',
+                    help='intra-op threads per training process (default: the cores split evenly between them)')
+parser.add_argument('--scaling', action='store_true', default=False,
+                    help='report the throughput & scaling efficiency of 1, 2, 4, ... up to --ddp-workers processes and exit')
+
+parser.add_argument('--network-description', default=None, metavar='PATH',
+                    help='network description file (default: {})'.format(
+                        ', '.join(' '.join(str(n) for n in spec) for spec in DEFAULT_NETWORK)))
+parser.add_argument('--describe', action='store_true', default=False,
+                    help='print the parameters & FLOPs of every layer and exit')
 
 # Add positional CLARGS
 # parser.add_argument(
@@ -181,10 +464,6 @@ parser.add_argument('--log-interval', type=int, default=10, metavar='N',
 #     help='Specify the cost function [cross, cross-l1, cross-l2].'
 # )
 # parser.add_argument(
-#     'network_description',
-#     help='Path to network description file.'
-# )
-# parser.add_argument(
 #     'epsilon',
 #     type=float,
 #     help='Epsilon error tolerance.'
@@ -204,53 +483,79 @@ parser.add_argument(
 )
 parser.add_argument(
     'train_folder_name',
-    help='Locating of training data.'
+    nargs='?',
+    help='Locating of training data (a folder or .npz shard).'
+)
+parser.add_argument(
+    '--generate',
+    type=int,
+    default=None,
+    metavar='N',
+    help='Use N cards generated in memory instead of train_folder_name.'
+)
+parser.add_argument(
+    '--generate-seed',
+    type=int,
+    default=None,
+    help='Seed for the generated cards (default: unseeded).'
 )
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
+    if args.k_fold and args.scaling:
+        raise Exception('--k-fold trains its folds in one process each; drop --scaling')
+    if args.k_fold and args.ddp_workers > 1:
+        raise Exception('--k-fold trains its folds in one process each; drop --ddp-workers')
+
     # CUDA setup
     args.cuda = not args.no_cuda and torch.cuda.is_available()
-    torch.manual_seed(RANDOM_SEED)
-    if args.cuda:
-        torch.cuda.manual_seed(RANDOM_SEED)
-    kwargs = {'num_workers': 1, 'pin_memory': True} if args.cuda else {}
 
-    # CNN setup
-    model = Net()
-    if args.cuda:
-        model.cuda()
-    optimizer = optim.SGD(
-        model.parameters(),
-        lr=args.lr,
-        momentum=args.momentum,
-        weight_decay=0  # L2 penalty value
+    # Network
+    args.network = None
+    if args.network_description is not None:
+        args.network = parse_network_description(args.network_description)
+    print(network_report(Net(args.network)))
+    if args.describe:
+        sys.exit(0)
+
+    # Data import, once for every split & fold
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize((NORMALIZE_MEAN,), (NORMALIZE_STD,))
+    ])
+    dataset = ZenerDataset(
+        args,
+        transform=transform,
+        mode=args.data_mode,
+        dtype=DATA_DTYPES[args.data_dtype],
+        share_memory=args.share_memory
     )
-
-    # Data import
-    train_loader = torch.utils.data.DataLoader(
-        ZenerDataset(
-            args,
-            train=True,
-            transform=transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,))
-            ])),
-        batch_size=args.batch_size, shuffle=True, **kwargs)
-
-    test_loader = torch.utils.data.DataLoader(
-        ZenerDataset(
-            args,
-            train=False,
-            transform=transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,))
-            ])),
-        batch_size=args.test_batch_size, shuffle=True, **kwargs)
-
-    # Train & test per epoch
-    for epoch in range(1, args.max_updates + 1):
-        train(epoch, train_loader)
-        test(test_loader)
+    targets = np.asarray(dataset.targets)
+
+    if args.k_fold:
+        workers = max(1, min(args.fold_workers, args.k_fold))
+        data = {
+            'dataset': dataset,
+            'args': args,
+            'threads': max(1, (os.cpu_count() or 1) // workers) if workers > 1 else None
+        }
+        results = run_folds(cnn_fold, k_folds(targets, args.k_fold, args.split_seed), data, workers)
+        print(report(aggregate(results)))
+    elif args.scaling or args.ddp_workers > 1:
+        from conv_distributed import fit_distributed, scaling_report
+
+        train_rows, test_rows = train_test_split(targets, args.test_fraction, args.split_seed)
+        if args.scaling:
+            scaling_report(dataset, train_rows, args, args.ddp_workers, args.threads)
+        else:
+            fit_distributed(dataset, train_rows, test_rows, args, args.ddp_workers, args.threads)
+            print('Model saved to {}'.format(args.model_file_name))
+    else:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        train_rows, test_rows = train_test_split(targets, args.test_fraction, args.split_seed)
+        model = fit(dataset, train_rows, test_rows, args)[0]
+        save_net(model, args.model_file_name)
+        print('Model saved to {}'.format(args.model_file_name))
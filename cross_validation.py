@@ -0,0 +1,147 @@
+"""
+Train/test splits and k-fold cross-validation over cards loaded once.
+
+Splits are index arrays into the loaded cards, so every fold is a view
+of the same data rather than a copy of it. Classes are stratified: each
+fold gets its share of every letter. Folds can run in parallel worker
+processes, which inherit the loaded data when they are forked, and
+their metrics are aggregated into a mean & standard deviation.
+
+:authors Jason, Nick, Sam
+"""
+
+from multiprocessing import Pool
+
+import numpy as np
+
+
+# Data of the running folds, set in each worker (see _init_folds)
+_fold_data = {}
+
+
+def _stratified_chunks(labels, k, seed=None):
+    """
+    :param labels: the label of every card
+    :param k: the number of chunks
+    :param seed: seed for the shuffle (unseeded if None)
+    :returns type list: k arrays of rows, each with about 1/k of the rows of every label
+    """
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+
+    chunks = [[] for _ in range(k)]
+    for label in np.unique(labels):
+        rows = rng.permutation(np.flatnonzero(labels == label))
+        for f, part in enumerate(np.array_split(rows, k)):
+            chunks[f].append(part)
+
+    return [np.sort(np.concatenate(parts)) for parts in chunks]
+
+
+def train_test_split(labels, test_fraction=0.2, seed=None):
+    """
+    :param labels: the label of every card
+    :param test_fraction: the fraction of every label held out for testing
+    :param seed: seed for the shuffle (unseeded if None)
+    :returns type tuple: the train & test rows
+    """
+    if not 0 < test_fraction < 1:
+        raise Exception('The test fraction must be between 0 and 1')
+
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+
+    test = []
+    for label in np.unique(labels):
+        rows = rng.permutation(np.flatnonzero(labels == label))
+        test.append(rows[:int(round(test_fraction * len(rows)))])
+    test = np.sort(np.concatenate(test))
+
+    return np.setdiff1d(np.arange(len(labels)), test), test
+
+
+def k_folds(labels, k, seed=None):
+    """
+    :param labels: the label of every card
+    :param k: the number of folds
+    :param seed: seed for the shuffle (unseeded if None)
+    :returns type list: (train rows, test rows) of every fold; every card is tested in exactly one fold
+    """
+    if k < 2:
+        raise Exception('k-fold cross-validation needs at least 2 folds')
+    if k > len(labels):
+        raise Exception('More folds than cards')
+
+    chunks = _stratified_chunks(labels, k, seed)
+    return [
+        (np.sort(np.concatenate(chunks[:f] + chunks[f + 1:])), chunks[f])
+        for f in range(k)
+    ]
+
+
+def _init_folds(data):
+    _fold_data.clear()
+    _fold_data.update(data)
+
+
+def _run_fold(job):
+    fold_func, f, train_rows, test_rows = job
+    metrics = fold_func(_fold_data, train_rows, test_rows)
+    metrics['fold'] = f
+    return metrics
+
+
+def run_folds(fold_func, folds, data, workers=1):
+    """
+    Run every fold, in parallel worker processes if workers > 1.
+
+    :param fold_func: module-level function(data, train rows, test rows) -> dict of metrics
+    :param folds: (train rows, test rows) of every fold, see k_folds
+    :param data: the loaded data, handed to fold_func in every worker
+    :param workers: the number of processes
+    :returns type list: the metrics of every fold, in fold order
+    """
+    jobs = [(fold_func, f, train_rows, test_rows) for f, (train_rows, test_rows) in enumerate(folds)]
+
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        _init_folds(data)
+        return [_run_fold(job) for job in jobs]
+
+    pool = Pool(workers, initializer=_init_folds, initargs=(data,))
+    try:
+        return pool.map(_run_fold, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def aggregate(results):
+    """
+    :param results: the metrics of every fold, see run_folds
+    :returns type dict: metric -> {'mean', 'std', 'folds'} for every numeric metric
+    """
+    summary = {}
+    for name in results[0]:
+        if name == 'fold':
+            continue
+        values = [float(metrics[name]) for metrics in results]
+        summary[name] = {
+            'mean': float(np.mean(values)),
+            'std': float(np.std(values)),
+            'folds': values
+        }
+
+    return summary
+
+
+def report(summary):
+    """
+    :param summary: see aggregate
+    :returns type str: one line per metric, mean +/- std over the folds
+    """
+    k = len(next(iter(summary.values()))['folds'])
+    return '\n'.join(
+        '{}-fold {}: {:.4f} +/- {:.4f}'.format(k, name, stats['mean'], stats['std'])
+        for name, stats in sorted(summary.items())
+    )
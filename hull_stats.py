@@ -0,0 +1,141 @@
+"""
+Centroids, radii and scaling factor (lambda) of the class convex hulls.
+
+:authors Jason, Nick, Sam
+"""
+
+import numpy as np
+
+
+class HullStats(object):
+    """
+    Running statistics of the positive and negative examples.
+
+    Batches are folded in with update(); old batches never have to be
+    re-read. The centroids are always exact. The radii are exact after a
+    single update; after further updates they are upper bounds found with
+    the triangle inequality, r <= r_old + |m_old - m_new|, which can only
+    make lambda smaller, i.e. shrink the hulls further apart.
+    """
+
+    def __init__(self, dim=25 * 25):
+        """
+        :param dim: the length of an input vector
+        """
+        self.n_plus = 0
+        self.n_minus = 0
+        self.sum_plus = np.zeros(dim, dtype=np.float64)
+        self.sum_minus = np.zeros(dim, dtype=np.float64)
+        self.r_plus = 0.0  # radius of positive convex hull
+        self.r_minus = 0.0  # radius of negative convex hull
+
+    @property
+    def m_plus(self):
+        """
+        :returns numpy array: the positive centroid
+        """
+        return self.sum_plus / max(self.n_plus, 1)
+
+    @property
+    def m_minus(self):
+        """
+        :returns numpy array: the negative centroid
+        """
+        return self.sum_minus / max(self.n_minus, 1)
+
+    @property
+    def r(self):
+        """
+        :returns type float: Euclidean distance between the centroids
+        """
+        return float(np.linalg.norm(self.m_plus - self.m_minus))
+
+    @property
+    def lam(self):
+        """
+        :returns type float: the scaling factor lambda of the convex hulls
+        """
+        return (0.5 * self.r) / (self.r_plus + self.r_minus)
+
+    def update(self, X_plus, X_minus):
+        """
+        Fold a batch of examples into the statistics.
+
+        :param X_plus: (n x d) matrix of positive training examples (may be empty)
+        :param X_minus: (n x d) matrix of negative training examples (may be empty)
+        :returns type HullStats: self
+        """
+        self.n_plus, self.sum_plus, self.r_plus = _fold(
+            self.n_plus, self.sum_plus, self.r_plus, X_plus)
+        self.n_minus, self.sum_minus, self.r_minus = _fold(
+            self.n_minus, self.sum_minus, self.r_minus, X_minus)
+
+        return self
+
+
+def _fold(n, total, radius, X):
+    """
+    Fold one batch of a single class into its count, sum and radius.
+
+    :returns type tuple: the new (count, sum, radius)
+    """
+    X = np.asarray(X)
+    if X.size == 0:
+        return n, total, radius
+    X = X.reshape(len(X), -1)
+
+    m_old = total / max(n, 1)
+    total = total + X.sum(axis=0, dtype=np.float64)
+    m_new = total / (n + len(X))
+
+    # |x - m|^2 = |x|^2 - 2 x.m + |m|^2, without materializing X - m
+    sq_dist = np.einsum('ij,ij->i', X, X, dtype=np.float64)
+    sq_dist -= 2 * np.dot(X, m_new)
+    sq_dist += np.dot(m_new, m_new)
+    batch_radius = float(np.sqrt(max(sq_dist.max(), 0)))
+
+    if n > 0:
+        radius = max(radius + float(np.linalg.norm(m_old - m_new)), batch_radius)
+    else:
+        radius = batch_radius
+
+    return n + len(X), total, radius
+
+
+def hull_stats(X_plus, X_minus):
+    """
+    Compute the exact hull statistics of a whole dataset in one pass.
+
+    :param X_plus: (n x d) matrix of positive training examples
+    :param X_minus: (n x d) matrix of negative training examples
+    :returns type HullStats: the statistics of both classes
+    """
+    return HullStats(dim=np.shape(X_plus)[-1]).update(X_plus, X_minus)
+
+
+def split_hull_stats(X, is_plus, sq_norms=None):
+    """
+    Compute the exact hull statistics of a dataset split by a mask, without
+    copying either class out of X.
+
+    :param X: (n x d) matrix of all training examples
+    :param is_plus: boolean mask of the positive examples
+    :param sq_norms: |x|^2 of every row of X, if already known (e.g. diag of X X^T)
+    :returns type HullStats: the statistics of both classes
+    """
+    is_plus = np.asarray(is_plus, dtype=bool)
+    if sq_norms is None:
+        sq_norms = np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+    stats = HullStats(dim=X.shape[1])
+    stats.n_plus = int(is_plus.sum())
+    stats.n_minus = len(is_plus) - stats.n_plus
+    stats.sum_plus = np.dot(is_plus.astype(np.float64), X)
+    stats.sum_minus = np.dot((~is_plus).astype(np.float64), X)
+
+    for mask, m, attr in ((is_plus, stats.m_plus, 'r_plus'), (~is_plus, stats.m_minus, 'r_minus')):
+        if mask.any():
+            sq_dist = sq_norms[mask] - 2 * np.dot(X, m)[mask] + np.dot(m, m)
+            setattr(stats, attr, float(np.sqrt(max(sq_dist.max(), 0))))
+
+    return stats
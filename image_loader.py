@@ -0,0 +1,114 @@
+"""
+Decoding of card images straight into numpy buffers.
+
+Cards are decoded with np.asarray(img) into rows of one preallocated,
+contiguous (n x 625) matrix of uint8 pixels (or float32/float64 values
+normalized to [0, 1]), never through per-pixel Python lists. Whole
+folders are decoded on a thread pool; PIL releases the GIL while it
+decodes.
+
+:authors Jason, Nick, Sam
+"""
+
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+CARD_SIZE = (25, 25)
+CARD_PIXELS = CARD_SIZE[0] * CARD_SIZE[1]
+
+# Threads decoding a folder (decoding is short, so a few are enough)
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def read_image(img_path, out=None, dtype=np.uint8):
+    """
+    Decode one card as a flattened greyscale vector.
+
+    :param img_path: the path to image file
+    :param out: the buffer to decode into, e.g. a row of a card matrix
+    :param dtype: dtype of the vector if out is not given; float dtypes are normalized to [0, 1]
+    :returns numpy array: the card, one value per pixel (out, if given)
+    """
+    with Image.open(img_path) as img:
+        if img.mode != 'L':
+            img = img.convert('L')
+        pixels = np.asarray(img).reshape(-1)
+
+    if out is None:
+        out = np.empty(pixels.shape, dtype=dtype)
+    elif out.shape != pixels.shape:
+        raise Exception('Card {} is not {}x{}'.format(img_path, *CARD_SIZE))
+
+    if out.dtype == np.uint8:
+        out[...] = pixels
+    else:
+        # normalize to 1's for white; 0's otherwise
+        np.multiply(pixels, 1.0 / 255, out=out, casting='unsafe')
+
+    return out
+
+
+def load_images(img_paths, dtype=np.uint8, workers=DEFAULT_WORKERS, out=None):
+    """
+    Decode many cards into one contiguous matrix, on a thread pool.
+
+    :param img_paths: the paths to the image files
+    :param dtype: dtype of the matrix; float dtypes are normalized to [0, 1]
+    :param workers: the number of decoding threads
+    :param out: the (n x 625) matrix to decode into (allocated if not given)
+    :returns numpy array: the (n x 625) matrix, one card per row in img_paths order
+    """
+    img_paths = list(img_paths)
+    if out is None:
+        out = np.empty((len(img_paths), CARD_PIXELS), dtype=dtype)
+
+    def decode(k):
+        read_image(img_paths[k], out[k])
+
+    if workers > 1 and len(img_paths) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            # list() re-raises the first decoding error
+            list(pool.map(decode, range(len(img_paths))))
+    else:
+        for k in range(len(img_paths)):
+            decode(k)
+
+    return out
+
+
+def list_cards(folder):
+    """
+    :param folder: the card folder
+    :returns type list: (index, ord() of the letter, path) of every '<index>_<letter>.png' card, sorted by index
+    """
+    cards = []
+    for img_path in glob.glob(os.path.join(folder, '*.png')):
+        f_name = os.path.splitext(os.path.basename(img_path))
+        ind, letter = f_name[0].split('_')
+        cards.append((int(ind), ord(letter.upper()), img_path))
+    cards.sort()
+
+    return cards
+
+
+def load_folder(folder, dtype=np.uint8, workers=DEFAULT_WORKERS):
+    """
+    Decode every card in a folder.
+
+    :param folder: the card folder
+    :param dtype: dtype of the pixel matrix; float dtypes are normalized to [0, 1]
+    :param workers: the number of decoding threads
+    :returns type tuple: pixels, labels & indices arrays sorted by index
+    """
+    cards = list_cards(folder)
+
+    indices = np.array([card[0] for card in cards], dtype=np.int64)
+    labels = np.array([card[1] for card in cards], dtype=np.uint8)
+    pixels = load_images([card[2] for card in cards], dtype, workers)
+
+    return pixels, labels, indices
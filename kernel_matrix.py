@@ -0,0 +1,315 @@
+"""
+Kernel (Gram) matrix and kernel row providers for the S-K algorithm.
+
+Every provider has row(k), the kernel values of example k against all
+examples, and diag, K(x_k, x_k) for every k.
+
+:authors Jason, Nick, Sam
+"""
+
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from kernels import DEFAULT_KERNEL, work_dtype
+
+
+# Storage backends for the Gram matrix ('lru' computes rows on demand, see KernelRowCache)
+STORAGE_MODES = ('memory', 'float32', 'disk', 'lru')
+
+DEFAULT_BLOCK_SIZE = 1024
+
+# Memory budget of a KernelRowCache
+DEFAULT_CACHE_MB = 1024
+
+
+def rows_per_block(row_bytes, block_bytes):
+    """
+    :param row_bytes: bytes taken by one row of a block
+    :param block_bytes: memory cap of one block
+    :returns type int: the number of rows that fit in a block (at least 1)
+    """
+    return max(1, int(block_bytes // max(row_bytes, 1)))
+
+
+class GramMatrix(object):
+    """
+    The full kernel matrix K[a, b] = K(x_a, x_b) of a stacked input matrix.
+
+    The matrix is computed once, one block of rows at a time, so that the S-K
+    loop only ever has to look rows up instead of calling the kernel.
+
+    Storage modes:
+        memory  -- ndarray held in RAM
+        float32 -- float32 ndarray held in RAM (half the memory)
+        disk    -- np.memmap backed by a file (RAM bounded by the page cache)
+
+    The matrix is float32 for float32 inputs (or float32 storage); otherwise, float64.
+    """
+
+    def __init__(self, X, kernel=DEFAULT_KERNEL, storage='memory', block_size=DEFAULT_BLOCK_SIZE, path=None):
+        """
+        :param X: the (n x d) matrix of input vectors, one example per row
+        :param kernel: the Kernel (see kernels.py)
+        :param storage: one of STORAGE_MODES
+        :param block_size: number of rows computed per matrix product
+        :param path: backing file for disk storage (a temp file if not given)
+        """
+        if storage not in STORAGE_MODES:
+            raise Exception('Unknown kernel storage: {}'.format(storage))
+
+        dtype = work_dtype(X)
+        X = np.asarray(X, dtype=dtype)
+        n = X.shape[0]
+        if storage == 'float32':
+            dtype = np.dtype(np.float32)
+
+        self.kernel = kernel
+        self.storage = storage
+        self.path = None
+        self._owns_path = False
+
+        if storage == 'disk':
+            if path is None:
+                fd, path = tempfile.mkstemp(suffix='.gram')
+                os.close(fd)
+                self._owns_path = True
+            self.path = path
+            self.K = np.memmap(path, dtype=dtype, mode='w+', shape=(n, n))
+        else:
+            self.K = np.empty((n, n), dtype=dtype)
+
+        # K(X, X), one block of rows at a time
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            self.K[start:stop] = kernel.matrix(X[start:stop], X)
+
+        if storage == 'disk':
+            self.K.flush()
+
+        # K(x_t, x_t) is needed on every update, keep it in full precision
+        self.diag = np.array(np.diagonal(self.K), dtype=np.float64)
+
+    def __len__(self):
+        return self.K.shape[0]
+
+    def __getitem__(self, key):
+        return self.K[key]
+
+    def row(self, k):
+        """
+        :param k: row index of the example in the stacked input matrix
+        :returns numpy array: K(x_k, x) for every x in the stacked input matrix
+        """
+        return self.K[k]
+
+    def close(self):
+        """
+        Release the matrix, deleting its backing file if it is a temp file.
+        """
+        if self.storage == 'disk':
+            del self.K
+            if self._owns_path and os.path.exists(self.path):
+                os.remove(self.path)
+        else:
+            self.K = None
+
+
+class ScaledGram(object):
+    """
+    Kernel rows of lambda-scaled inputs, derived from the linear Gram matrix
+    G = X X^T of the unscaled inputs, so that G can be shared between
+    classifiers that scale the same inputs differently.
+
+    An example x_a of class s_a (0 = positive, 1 = negative) is scaled to
+    x'_a = lam x_a + (1 - lam) m_sa, hence
+
+        x'_a . x'_b = lam^2 G_ab + lam (1 - lam) (x_a . m_sb + x_b . m_sa)
+                      + (1 - lam)^2 m_sa . m_sb
+
+    Rows are in X_plus-over-X_minus order; row k is row perm[k] of G.
+    They are float32 if G is; the per-example terms are kept in float64.
+    """
+
+    def __init__(self, G, X, perm, n_plus, lam, m_plus, m_minus, kernel=DEFAULT_KERNEL):
+        """
+        :param G: the (N x N) linear Gram matrix of the unscaled inputs (or a LinearRows)
+        :param X: the (N x d) matrix of unscaled inputs (or a bitpack.PackedCards)
+        :param perm: the rows of G of the positive examples followed by the negative ones
+        :param n_plus: the number of positive examples
+        :param lam: the scaling factor lambda
+        :param m_plus: the positive centroid
+        :param m_minus: the negative centroid
+        :param kernel: the Kernel (see kernels.py)
+        """
+        self.G = G
+        self.perm = np.asarray(perm)
+        self.kernel = kernel
+        self.lam = lam
+        self.dtype = np.dtype(G.dtype)
+
+        n = len(self.perm)
+        self.cls = np.zeros(n, dtype=np.intp)
+        self.cls[n_plus:] = 1
+
+        M = np.array([m_plus, m_minus], dtype=np.float64)
+        MM = np.dot(M, M.T)
+
+        # P[k, s] = x_k . m_s
+        self.P = X.dot(M.T)[self.perm]
+
+        # The part of row k that depends only on the class of x_k
+        self._base = [
+            lam * (1 - lam) * self.P[:, s] + (1 - lam)**2 * MM[s, self.cls]
+            for s in (0, 1)
+        ]
+
+        G_diag = np.asarray(G.diagonal(), dtype=np.float64)[self.perm]
+        dots = lam**2 * G_diag
+        dots += 2 * lam * (1 - lam) * self.P[np.arange(n), self.cls]
+        dots += (1 - lam)**2 * MM[self.cls, self.cls]
+
+        # |x'_k|^2 of every scaled example
+        self.sq = dots
+        self.diag = kernel.values(dots.copy(), dots, dots)
+
+    def __len__(self):
+        return len(self.perm)
+
+    def row(self, k):
+        """
+        :param k: row index of the example in X_plus stacked over X_minus
+        :returns numpy array: K(x'_k, x') for every scaled example x'
+        """
+        dots = np.asarray(self.G[self.perm[k]], dtype=self.dtype)[self.perm]
+        dots *= self.lam**2
+        dots += self.lam * (1 - self.lam) * self.P[k, self.cls]
+        dots += self._base[self.cls[k]]
+        return self.kernel.values(dots, self.sq[k], self.sq)
+
+    def close(self):
+        """
+        Drop the references to the shared matrices.
+        """
+        self.G = None
+
+
+class LinearRows(object):
+    """
+    Rows of the linear Gram matrix X X^T, computed on demand, for when the
+    full matrix does not fit in memory. Indexes like the matrix it stands for.
+    """
+
+    def __init__(self, X):
+        """
+        :param X: the (n x d) matrix of input vectors
+        """
+        self.X = X
+        self.dtype = X.dtype
+
+    def __getitem__(self, k):
+        return np.dot(self.X, self.X[k])
+
+    def diagonal(self):
+        return np.einsum('ij,ij->i', self.X, self.X, dtype=np.float64)
+
+
+class KernelRowCache(object):
+    """
+    Kernel rows computed on demand and kept in an LRU cache bounded by a
+    memory budget.
+
+    The S-K loop only touches the row of the current x_t (plus the rows of
+    the initial guesses), and near convergence the same few support vectors
+    are picked again and again, so most lookups hit the cache.
+    """
+
+    def __init__(self, compute_row, diag, budget_mb=DEFAULT_CACHE_MB, itemsize=8):
+        """
+        :param compute_row: maps a row index k to the kernel row K(x_k, x)
+        :param diag: K(x_k, x_k) for every k
+        :param budget_mb: the most memory the cached rows may take, in MB
+        :param itemsize: bytes per kernel value of a row (4 for float32 rows)
+        """
+        self.compute_row = compute_row
+        self.diag = np.asarray(diag, dtype=np.float64)
+        self.budget_bytes = budget_mb * 2**20
+        self.itemsize = itemsize
+
+        # Every row is n values; always keep at least the rows in use
+        row_bytes = len(self.diag) * itemsize
+        self.max_rows = max(2, int(self.budget_bytes // max(row_bytes, 1)))
+
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def for_inputs(cls, X, kernel=DEFAULT_KERNEL, budget_mb=DEFAULT_CACHE_MB):
+        """
+        :param X: the (n x d) matrix of input vectors
+        :param kernel: the Kernel (see kernels.py)
+        :returns type KernelRowCache: cache of the kernel rows of X
+        """
+        X = np.asarray(X, dtype=work_dtype(X))
+        sq = np.einsum('ij,ij->i', X, X, dtype=np.float64)
+        diag = kernel.values(sq.copy(), sq, sq)
+
+        def compute_row(k):
+            return kernel.values(np.dot(X, X[k]), sq[k], sq)
+
+        return cls(compute_row, diag, budget_mb, X.dtype.itemsize)
+
+    def __len__(self):
+        return len(self.diag)
+
+    def row(self, k):
+        """
+        :param k: row index of the example
+        :returns numpy array: K(x_k, x) for every example x
+        """
+        row = self.rows.get(k)
+        if row is not None:
+            self.hits += 1
+            self.rows.move_to_end(k)
+            return row
+
+        self.misses += 1
+        row = self.compute_row(k)
+        self.rows[k] = row
+        if len(self.rows) > self.max_rows:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+
+        return row
+
+    @property
+    def stats(self):
+        """
+        :returns type dict: hit & miss counts and memory use of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'rows_cached': len(self.rows),
+            'cached_mb': len(self.rows) * len(self.diag) * self.itemsize / 2.0**20
+        }
+
+    def report(self):
+        """
+        :returns type str: a one-line summary of the cache statistics
+        """
+        return ('Kernel row cache: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate), '
+                '{evictions} evictions, {rows_cached} rows / {cached_mb:.1f} MB cached').format(**self.stats)
+
+    def close(self):
+        """
+        Drop the cached rows.
+        """
+        self.rows.clear()
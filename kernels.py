@@ -0,0 +1,292 @@
+"""
+Kernel functions for the SVM, with vectorized batch evaluation.
+
+Every kernel here is a function of the dot product x . y (and, for RBF,
+of |x|^2 and |y|^2), so each one is written once, in from_dots, and
+pair / row / matrix evaluation all come down to a single BLAS product.
+
+Rows and matrices of float32 inputs are computed (and returned) in
+float32; anything else is computed in float64. float32 kernel values that
+overflow raise an Exception instead of turning into inf.
+
+:authors Jason, Nick, Sam
+"""
+
+import numpy as np
+
+
+def work_dtype(*arrays):
+    """
+    :param arrays: input vectors or matrices
+    :returns numpy dtype: float32 if every input is float32; otherwise, float64
+    """
+    if all(np.asarray(arr).dtype == np.float32 for arr in arrays):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def _as_float(dots):
+    """
+    :param dots: dot products
+    :returns numpy array: dots as float32 if they are float32; otherwise, as float64
+    """
+    dots = np.asarray(dots)
+    if dots.dtype == np.float32:
+        return dots
+    return dots.astype(np.float64, copy=False)
+
+
+def _checked(values):
+    """
+    :param values: kernel values
+    :returns numpy array: values, if none of them overflowed float32
+    """
+    if values.dtype == np.float32 and not np.isfinite(values).all():
+        raise Exception('Kernel values overflow float32; use float64 inputs')
+    return values
+
+
+class Kernel(object):
+    """
+    Base class of the kernels. Subclasses set name & needs_norms and
+    implement from_dots.
+    """
+    name = None
+    needs_norms = False  # True if the kernel needs |x|^2 & |y|^2 as well as x . y
+
+    def from_dots(self, dots, sq_x=None, sq_y=None):
+        """
+        :param dots: x . y, as a float32/float64 scalar or array (may be overwritten)
+        :param sq_x: |x|^2, broadcastable against dots (only if needs_norms)
+        :param sq_y: |y|^2, broadcastable against dots (only if needs_norms)
+        :returns: K(x, y)
+        """
+        raise NotImplementedError
+
+    def values(self, dots, sq_x=None, sq_y=None):
+        """
+        from_dots, raising if float32 kernel values overflow (every row &
+        matrix of kernel values should come from here).
+
+        :param dots: x . y, as a float32/float64 scalar or array (may be overwritten)
+        :param sq_x: |x|^2, broadcastable against dots (only if needs_norms)
+        :param sq_y: |y|^2, broadcastable against dots (only if needs_norms)
+        :returns: K(x, y)
+        """
+        return _checked(self.from_dots(dots, sq_x, sq_y))
+
+    def pair(self, x, y):
+        """
+        :param x: input vector
+        :param y: input vector
+        :returns type float: K(x, y), in float64
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        if x.shape != y.shape:
+            raise Exception('Kernel fnc cannot dot vectors of diff dims')
+
+        dots = np.asarray(np.dot(x, y))
+        if self.needs_norms:
+            return float(self.from_dots(dots, np.dot(x, x), np.dot(y, y)))
+        return float(self.from_dots(dots))
+
+    def row(self, x, Y):
+        """
+        :param x: input vector
+        :param Y: (m x d) matrix of input vectors
+        :returns numpy array: K(x, y) for every row y of Y (float32 if x & Y are)
+        """
+        dtype = work_dtype(x, Y)
+        x = np.asarray(x, dtype=dtype).ravel()
+        dots = np.dot(np.asarray(Y, dtype=dtype), x)
+        if self.needs_norms:
+            return self.values(dots, sq_norms(x[None, :])[0], sq_norms(Y))
+        return self.values(dots)
+
+    def matrix(self, X, Y=None):
+        """
+        :param X: (n x d) matrix of input vectors
+        :param Y: (m x d) matrix of input vectors (X if not given)
+        :returns numpy array: the (n x m) matrix K(x, y) (float32 if X & Y are)
+        """
+        Y = X if Y is None else Y
+        dtype = work_dtype(X, Y)
+        dots = np.dot(np.asarray(X, dtype=dtype), np.transpose(np.asarray(Y, dtype=dtype)))
+        if self.needs_norms:
+            return self.values(dots, sq_norms(X)[:, None], sq_norms(Y)[None, :])
+        return self.values(dots)
+
+    @property
+    def spec(self):
+        """
+        :returns type dict: the name & parameters of the kernel, see kernel_from_spec
+        """
+        spec = {'name': self.name}
+        spec.update(self.params)
+        return spec
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={}'.format(k, v) for k, v in sorted(self.params.items())))
+
+
+class PolyKernel(Kernel):
+    """
+    K(x, y) = (gamma x . y + coef0)**degree
+    """
+    name = 'poly'
+
+    def __init__(self, degree=4, coef0=1, gamma=1):
+        self.degree = degree
+        self.coef0 = coef0
+        self.gamma = gamma
+        self.params = {'degree': degree, 'coef0': coef0, 'gamma': gamma}
+
+    def from_dots(self, dots, sq_x=None, sq_y=None):
+        dots = _as_float(dots)
+        if self.gamma != 1:
+            dots *= self.gamma
+        dots += self.coef0
+        dots **= self.degree
+        return dots
+
+
+class LinearKernel(Kernel):
+    """
+    K(x, y) = x . y
+    """
+    name = 'linear'
+
+    def __init__(self):
+        self.params = {}
+
+    def from_dots(self, dots, sq_x=None, sq_y=None):
+        return _as_float(dots)
+
+
+class RBFKernel(Kernel):
+    """
+    K(x, y) = exp(-gamma |x - y|^2)
+    """
+    name = 'rbf'
+    needs_norms = True
+
+    def __init__(self, gamma=1.0 / 625):
+        self.gamma = gamma
+        self.params = {'gamma': gamma}
+
+    def from_dots(self, dots, sq_x=None, sq_y=None):
+        # |x - y|^2 = |x|^2 + |y|^2 - 2 x . y
+        dots = _as_float(dots)
+        dots *= -2
+        dots += sq_x
+        dots += sq_y
+        np.maximum(dots, 0, out=dots)
+        dots *= -self.gamma
+        np.exp(dots, out=dots)
+        return dots
+
+
+class SigmoidKernel(Kernel):
+    """
+    K(x, y) = tanh(gamma x . y + coef0)
+    """
+    name = 'sigmoid'
+
+    def __init__(self, gamma=1.0 / 625, coef0=0):
+        self.gamma = gamma
+        self.coef0 = coef0
+        self.params = {'gamma': gamma, 'coef0': coef0}
+
+    def from_dots(self, dots, sq_x=None, sq_y=None):
+        dots = _as_float(dots)
+        dots *= self.gamma
+        dots += self.coef0
+        np.tanh(dots, out=dots)
+        return dots
+
+
+KERNELS = {
+    PolyKernel.name: PolyKernel,
+    LinearKernel.name: LinearKernel,
+    RBFKernel.name: RBFKernel,
+    SigmoidKernel.name: SigmoidKernel
+}
+
+# The kernel of models saved before kernels were recorded
+DEFAULT_KERNEL = PolyKernel()
+
+
+def sq_norms(X):
+    """
+    :param X: (n x d) matrix of input vectors
+    :returns numpy array: |x|^2 of every row of X
+    """
+    X = np.asarray(X)
+    return np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+
+def kernel_from_spec(spec):
+    """
+    :param spec: dict of kernel name & parameters (see Kernel.spec), or None
+    :returns type Kernel: the kernel, DEFAULT_KERNEL if spec is None
+    """
+    if not spec:
+        return DEFAULT_KERNEL
+
+    params = dict(spec)
+    name = params.pop('name')
+    try:
+        return KERNELS[name](**params)
+    except KeyError:
+        raise Exception('Unknown kernel: {}'.format(name))
+
+
+def kernel_from_args(args):
+    """
+    :param args: the CLARGS from user input (kernel, degree, coef0, gamma)
+    :returns type Kernel: the kernel they select
+    """
+    if args.kernel == 'poly':
+        return PolyKernel(args.degree, args.coef0, 1 if args.gamma is None else args.gamma)
+    if args.kernel == 'linear':
+        return LinearKernel()
+    if args.kernel == 'rbf':
+        return RBFKernel() if args.gamma is None else RBFKernel(args.gamma)
+    if args.kernel == 'sigmoid':
+        return SigmoidKernel(coef0=args.coef0) if args.gamma is None else SigmoidKernel(args.gamma, args.coef0)
+
+    raise Exception('Unknown kernel: {}'.format(args.kernel))
+
+
+def add_kernel_args(parser):
+    """
+    Add the kernel selection CLARGS to an argparse parser.
+
+    :param parser: the parser
+    """
+    parser.add_argument(
+        '--kernel',
+        choices=sorted(KERNELS),
+        default='poly',
+        help='Kernel function (default: poly).'
+    )
+    parser.add_argument(
+        '--degree',
+        type=int,
+        default=4,
+        help='Degree of the poly kernel (default: 4).'
+    )
+    parser.add_argument(
+        '--coef0',
+        type=float,
+        default=1,
+        help='Constant term of the poly & sigmoid kernels (default: 1).'
+    )
+    parser.add_argument(
+        '--gamma',
+        type=float,
+        default=None,
+        help='Scale of x . y (poly, sigmoid) or |x - y|^2 (rbf) (default: 1 for poly, 1/625 otherwise).'
+    )
@@ -0,0 +1,116 @@
+"""
+Versioned, memory-mappable container for a set of named numpy arrays.
+
+Layout:
+    4 bytes     magic (b'ZPAK')
+    uint32      format version
+    uint64      header length
+    header      JSON: {'meta': {...}, 'arrays': {name: {dtype, shape, offset}}}
+    padding     up to a multiple of ALIGN
+    data        raw C-ordered arrays, each starting on an ALIGN boundary
+
+:authors Jason, Nick, Sam
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+
+MAGIC = b'ZPAK'
+VERSION = 1
+ALIGN = 64
+
+_PREFIX = struct.Struct('<4sIQ')
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def is_packed(path):
+    """
+    :param path: path to any file
+    :returns type bool: True if the file is a packed array file; otherwise, False
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def write_packed(path, arrays, meta=None):
+    """
+    Write arrays & metadata to a packed file.
+
+    The file is written next to its destination and renamed into place, so
+    readers never see a partially written file.
+
+    :param path: the output file
+    :param arrays: dict of name -> numpy array
+    :param meta: JSON-serializable dict of metadata
+    """
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        layout[name] = {
+            'dtype': arr.dtype.str,
+            'shape': list(arr.shape),
+            'offset': offset
+        }
+        offset = _align(offset + arr.nbytes)
+
+    header = json.dumps({'meta': meta or {}, 'arrays': layout}).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header))
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for name, arr in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(arr.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def read_packed(path, mmap=True):
+    """
+    Read a packed file.
+
+    :param path: the packed file
+    :param mmap: if True, arrays are read-only views of a memory map of the file
+    :returns type tuple: dict of name -> numpy array, dict of metadata
+    """
+    with open(path, 'rb') as f:
+        magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise Exception('{} is not a packed array file'.format(path))
+        if version > VERSION:
+            raise Exception('Packed file version {} is not supported'.format(version))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+
+    data_start = _align(_PREFIX.size + header_len)
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        with open(path, 'rb') as f:
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        start = data_start + spec['offset']
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays[name] = buf[start:start + nbytes].view(dtype).reshape(shape)
+
+    return arrays, header['meta']
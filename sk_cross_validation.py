@@ -0,0 +1,79 @@
+"""
+K-fold cross-validation of the S-K SVM of one class.
+
+The cards are loaded once; every fold trains on its training rows
+(see sk_train.inputs_from_cards), scores its held-out rows and reports
+the fraction correct, false positive & false negative, as
+svm_model_tester.py does. Folds run in parallel with --workers.
+
+:authors Jason, Nick, Sam
+"""
+
+import argparse
+
+import numpy as np
+
+from cross_validation import aggregate, k_folds, run_folds
+from sk_train import inputs_from_cards, sk_algorithm, support_vector_data
+from svm_model import compact_model
+from svm_model_tester import score_batch
+from utils import load_input_cards
+
+
+def fold_args(args):
+    """
+    :param args: the CLARGS from user input
+    :returns: a copy of the CLARGS for a fold, without checkpoints, traces or profiles (their files would be shared)
+    """
+    args = argparse.Namespace(**vars(args))
+    args.checkpoint_every = 0
+    args.checkpoint_seconds = 0
+    args.resume = False
+    args.metrics = None
+    args.profile = None
+    return args
+
+
+def sk_fold(data, train_rows, test_rows):
+    """
+    Train on the training rows and score the held-out rows.
+
+    :param data: pixels, labels, indices & args (see cross_validate)
+    :param train_rows: the rows to train on
+    :param test_rows: the rows to test on
+    :returns type dict: the fractions correct, false positive & false negative of the held-out rows
+    """
+    pixels, labels, args = data['pixels'], data['labels'], data['args']
+
+    input_data = inputs_from_cards(pixels[train_rows], labels[train_rows], data['indices'][train_rows], args)
+    params = sk_algorithm(input_data, args)
+    if 'cards' in input_data:
+        params, input_data = support_vector_data(params, input_data)
+
+    arrays, meta = compact_model(params, input_data)
+    model = dict(arrays)
+    model.update(meta)
+
+    predicted = score_batch(model, pixels[test_rows] / 255, dtype=args.dtype) >= 0
+    actual = labels[test_rows] == ord(args.class_letter.upper())
+
+    return {
+        'correct': np.mean(predicted == actual),
+        'false_positive': np.mean(predicted & ~actual),
+        'false_negative': np.mean(~predicted & actual)
+    }
+
+
+def cross_validate(args):
+    """
+    :param args: the CLARGS from user input, with k_fold folds
+    :returns type dict: the metrics aggregated over the folds, see cross_validation.aggregate
+    """
+    pixels, labels, indices = load_input_cards(args)
+    labels = np.asarray(labels)
+    indices = np.asarray(indices)
+
+    folds = k_folds(labels, args.k_fold, args.split_seed)
+    data = {'pixels': pixels, 'labels': labels, 'indices': indices, 'args': fold_args(args)}
+
+    return aggregate(run_folds(sk_fold, folds, data, args.workers))
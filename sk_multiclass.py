@@ -0,0 +1,232 @@
+"""
+One-vs-rest multi-class S-K training across a process pool.
+
+The cards are loaded once. Their normalized pixel matrix X and its linear
+Gram matrix G = X X^T are put in shared memory (or, with --kernel-storage
+disk, a shared memmap), and every worker derives the kernel (see kernels.py) of
+its own lambda-scaled classes from them (see kernel_matrix.ScaledGram),
+so no worker copies the data or builds its own kernel matrix. With
+--kernel-storage lru, G is never built; each worker computes the rows it
+needs from X and keeps them in a KernelRowCache. With --binary, only the
+bit-packed cards are shared (see bitpack.py) and G is never built either;
+its rows are popcounts of the packed cards.
+
+:authors Jason, Nick, Sam
+"""
+
+import os
+import tempfile
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+from bitpack import PackedCards
+from hull_stats import split_hull_stats
+from kernel_matrix import KernelRowCache, LinearRows, ScaledGram
+from kernels import kernel_from_args
+from sk_train import sk_algorithm
+from svm_model import compact_model
+from utils import load_input_cards
+
+
+# Arrays shared with the worker processes (see _init_worker)
+_shared = {}
+
+
+def share_array(shape, dtype, path=None):
+    """
+    Allocate an array that worker processes can attach to.
+
+    :param shape: shape of the array
+    :param dtype: dtype of the array
+    :param path: if given, back the array with this file instead of shared memory
+    :returns type tuple: the array, its handle (to close) & the spec to attach with
+    """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+
+    if path is not None:
+        arr = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        return arr, None, ('file', path, shape, dtype.str)
+
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return arr, shm, ('shm', shm.name, shape, dtype.str)
+
+
+def attach_array(spec):
+    """
+    :param spec: the spec returned by share_array
+    :returns type tuple: the shared array & its handle (to close)
+    """
+    kind, name, shape, dtype = spec
+    if kind == 'file':
+        return np.memmap(name, dtype=dtype, mode='r', shape=shape), None
+
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def _init_worker(X_spec, G_spec, labels, indices, packed=None):
+    _shared['X'], _shared['X_shm'] = attach_array(X_spec)
+    if packed is not None:
+        # X_spec holds the bit-packed words; (n_pixels, dtype) of the cards
+        _shared['X'] = _shared['G'] = PackedCards(_shared['X'], *packed)
+    elif G_spec is not None:
+        _shared['G'], _shared['G_shm'] = attach_array(G_spec)
+    else:
+        _shared['G'] = LinearRows(_shared['X'])
+    _shared['labels'] = labels
+    _shared['indices'] = indices
+
+
+def _card_rows(X, rows):
+    """
+    :param X: the shared inputs (a matrix or a PackedCards)
+    :param rows: the rows to take
+    :returns numpy array: the unscaled cards of the rows
+    """
+    if isinstance(X, PackedCards):
+        return X.unpack(rows)
+    return X[rows]
+
+
+def train_class(letter, args):
+    """
+    Train the one-vs-rest classifier of one class on the shared data.
+
+    :param letter: the positive class letter
+    :param args: the CLARGS from user input
+    :returns type tuple: the class letter and its compact model (arrays, meta)
+    """
+    X = _shared['X']
+    G = _shared['G']
+    indices = _shared['indices']
+
+    is_plus = _shared['labels'] == ord(letter)
+    plus_rows = np.flatnonzero(is_plus)
+    minus_rows = np.flatnonzero(~is_plus)
+
+    if len(plus_rows) < 1 or len(minus_rows) < 1:
+        raise Exception('NO DATA')
+
+    if isinstance(X, PackedCards):
+        stats = X.hull_stats(is_plus)
+    else:
+        stats = split_hull_stats(X, is_plus, G.diagonal())
+    lam, m_plus, m_minus = stats.lam, stats.m_plus, stats.m_minus
+    print('{}: lambda = {}'.format(letter, lam))
+
+    kernel = kernel_from_args(args)
+    gram = ScaledGram(G, X, np.concatenate((plus_rows, minus_rows)), len(plus_rows), lam, m_plus, m_minus, kernel)
+    if args.kernel_storage == 'lru':
+        gram = KernelRowCache(gram.row, gram.diag, args.kernel_cache_mb, gram.dtype.itemsize)
+    input_data = {
+        'class_letter': letter,
+        'kernel': kernel.spec,
+        'dtype': X.dtype.name,
+        'I_plus': [str(ind) for ind in indices[plus_rows]],
+        'I_minus': [str(ind) for ind in indices[minus_rows]]
+    }
+
+    params = sk_algorithm(input_data, args, gram)
+    gram.close()
+
+    # Scale only the support vectors
+    sv_i = np.flatnonzero(params.alpha_i)
+    sv_j = np.flatnonzero(params.alpha_j)
+    sv_data = {
+        'X_plus': lam * _card_rows(X, plus_rows[sv_i]) + (1 - lam) * m_plus,
+        'X_minus': lam * _card_rows(X, minus_rows[sv_j]) + (1 - lam) * m_minus,
+        'I_plus': indices[plus_rows[sv_i]],
+        'I_minus': indices[minus_rows[sv_j]],
+        'class_letter': letter,
+        'lambda': lam,
+        'm_plus': m_plus,
+        'm_minus': m_minus,
+        'kernel': kernel.spec
+    }
+    sv_params = {
+        'alpha_i': params.alpha_i[sv_i],
+        'alpha_j': params.alpha_j[sv_j],
+        'A': params.A,
+        'B': params.B,
+        'C': params.C
+    }
+
+    return letter, compact_model(sv_params, sv_data)
+
+
+def _train_class(job):
+    return train_class(*job)
+
+
+def train_one_vs_rest(args):
+    """
+    Train one classifier per class letter in the data, in parallel.
+
+    :param args: the CLARGS from user input
+    :returns type dict: class letter -> compact model (arrays, meta), see svm_model.export_bundle
+    """
+    pixels, labels, indices = load_input_cards(args)
+    labels = np.asarray(labels)
+    indices = np.asarray(indices)
+    letters = [chr(label) for label in np.unique(labels)]
+
+    if len(letters) < 2:
+        raise Exception('NO DATA')
+
+    n, d = pixels.shape
+    X_dtype = np.dtype(getattr(args, 'dtype', 'float64'))
+    G_dtype = np.float32 if args.kernel_storage == 'float32' else X_dtype
+    binary = getattr(args, 'binary', False)
+    G_path = None
+    if args.kernel_storage == 'disk' and not binary:
+        fd, G_path = tempfile.mkstemp(suffix='.gram')
+        os.close(fd)
+
+    # With --binary, X holds the bit-packed words of the cards
+    packed = None
+    if binary:
+        words = PackedCards.from_pixels(pixels, X_dtype).words
+        packed = (d, X_dtype.str)
+        X, X_shm, X_spec = share_array(words.shape, words.dtype)
+        X[...] = words
+    else:
+        X, X_shm, X_spec = share_array((n, d), X_dtype)
+    G, G_shm, G_spec = None, None, None
+    if args.kernel_storage != 'lru' and not binary:
+        G, G_shm, G_spec = share_array((n, n), G_dtype, G_path)
+
+    try:
+        if not binary:
+            # Normalize to 1's for white; 0's otherwise
+            np.divide(pixels, 255, out=X)
+
+        # Linear Gram matrix, one block of rows at a time
+        # (with lru, each worker computes & caches the rows it needs)
+        if G is not None:
+            for start in range(0, n, args.kernel_block_size):
+                stop = min(start + args.kernel_block_size, n)
+                G[start:stop] = np.dot(X[start:stop], X.T)
+        print('Data inputs initialized')
+
+        workers = max(1, min(args.workers, len(letters)))
+        jobs = [(letter, args) for letter in letters]
+
+        pool = Pool(workers, initializer=_init_worker, initargs=(X_spec, G_spec, labels, indices, packed))
+        try:
+            models = dict(pool.map(_train_class, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        del X, G
+        for shm in (X_shm, G_shm):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        if G_path is not None:
+            os.remove(G_path)
+
+    return models
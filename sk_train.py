@@ -4,13 +4,25 @@ Train an SVM on a polynomial-kernel transformed dataset.
 """
 
 import argparse
-import glob
-import math
 import os
 import pickle
+import sys
 
 import numpy as np
-from PIL import Image
+
+from bitpack import PackedCards
+from checkpoint import Checkpointer, load_checkpoint
+from hull_stats import hull_stats
+from kernel_matrix import DEFAULT_CACHE_MB, GramMatrix, KernelRowCache, ScaledGram, STORAGE_MODES
+from kernels import PolyKernel, add_kernel_args, kernel_from_args, kernel_from_spec
+from stop_condition import DEFAULT_CHUNK_SIZE, DEFAULT_WORKERS as STOP_WORKERS, StopCondition
+from svm_model import export_bundle, export_compact_model, load_model, support_vectors
+from training_monitor import TrainingMonitor
+from utils import load_input_cards
+
+
+# Precisions of the inputs & kernel values (D, E & A~C are always float64)
+DTYPES = ('float64', 'float32')
 
 
 ############################################################
@@ -22,302 +34,440 @@ def poly_kernel(x, x_i, p=4, c=1):
     """
     :param x_t: training input
     :param x_i: input vector
-    :returns type int: The kernel output if successful; otherwise, 0
+    :returns type float: The kernel output (see kernels.PolyKernel)
     """
-    x_t = np.transpose(x)
-    try:
-        return (np.dot(x_t, x_i) + c)**p
-    except ValueError:
-        print('Input: {}'.format(x_t.shape))
-        print('Input: {}'.format(x_i))
-        raise Exception('Kernel fnc cannot dot vectors of diff dims')
-
-    return 0
+    return PolyKernel(p, c).pair(x, x_i)
 
 
 def calc_lambda(X_plus, X_minus):
     """
     Calculate scaling factor (lambda) of convex hull.
 
-    :param X_plus: the list of numpy vectors that are positive training examples
-    :param X_minus: the list of numpy vectors that are negative training examples
+    :param X_plus: the (n x d) matrix of positive training examples
+    :param X_minus: the (n x d) matrix of negative training examples
     :returns type <float>:
     """
 
-    m_plus = np.array([])  # positive centroid
-    m_minus = np.array([])  # negative centroid
-
-    # calculate m_plus and m_minus
-    for i in xrange(25 * 25):
-        m_plus_i = 0
-        for X_plus_i in X_plus:
-            m_plus_i += X_plus_i[i]
-
-        m_minus_i = 0
-        for X_minus_i in X_minus:
-            m_minus_i += X_minus_i[i]
-
-        m_plus = np.append(m_plus, m_plus_i)
-        m_minus = np.append(m_minus, m_minus_i)
-
-    m_plus /= float(len(X_plus))
-    m_minus /= float(len(X_minus))
-
-    # calculate r from m_plus and m_minus (Euclidean distance between centroids)
-    r = np.linalg.norm(m_plus - m_minus)
-
-    # calculate r_plus (radius of positive convex hull)
-    r_plus = 0
-    for X_plus_i in X_plus:
-        r_plus = max(r_plus, np.linalg.norm(X_plus_i - m_plus))
-
-    # calculate r_minus (radius of negative convex hull)
-    r_minus = 0
-    for X_minus_i in X_minus:
-        r_minus = max(r_minus, np.linalg.norm(X_minus_i - m_minus))
+    # centroids, radii & lambda in one vectorized pass (see hull_stats)
+    stats = hull_stats(X_plus, X_minus)
 
-    lam = (0.5 * r) / (r_plus + r_minus)
+    lam = stats.lam
     print('lambda = {}'.format(lam))
 
     # return lambda and the centroids
-    return lam, m_plus, m_minus
+    return lam, stats.m_plus, stats.m_minus
 
 
-def scale_inputs(X_plus, X_minus):
-    lam, m_plus, m_minus = calc_lambda(X_plus, X_minus)
-    for i, x_i in enumerate(X_plus):
-        X_plus[i] = lam * x_i + (1 - lam) * m_plus
-    for j, x_j in enumerate(X_minus):
-        X_minus[j] = lam * x_j + (1 - lam) * m_minus
-
-    # print 'xplus' + str(X_plus)
-    # print 'xminus' + str(X_minus)
-    return X_plus, X_minus
-
-
-def calc_mi(x_k, p, ind):
+def scale_inputs(X_plus, X_minus, scaling=None):
     """
-    Calculate the m_i to find the one closest to being within epsilon
-    of the correct side of the hyperplane.  Important for stop condition.
-
-    This is for the positive examples I_plus.
+    Scale each convex hull towards its centroid by lambda, in place.
 
-    :param x_k: the k-th elem of x (pos ex)
-    :param p: params dict of alphas & letters
-    :returns type float: the m_i value
+    :param X_plus: the (n x d) float matrix of positive training examples
+    :param X_minus: the (n x d) float matrix of negative training examples
+    :param scaling: (lambda, m_plus, m_minus) to use; calculated from the inputs if not given
+    :returns type tuple: the scaled X_plus & X_minus
     """
+    lam, m_plus, m_minus = scaling or calc_lambda(X_plus, X_minus)
 
-    D_i = p['D'][ind]
-    E_i = p['E'][ind]
+    X_plus *= lam
+    X_plus += (1 - lam) * m_plus
+    X_minus *= lam
+    X_minus += (1 - lam) * m_minus
 
-    m_i_num = float(D_i - E_i + p['B'] - p['C'])
-    try:
-        m_i_denom = math.sqrt(p['A'] + p['B'] -2*p['C'])
-    except ValueError:
-        raise Exception('Check the stop condition denom for m_i')
-
-    return m_i_num/m_i_denom
+    return X_plus, X_minus
 
 
-def calc_mj(x_k, p, ind):
-    """
-    Calculate the m_j to find the one closest to being within epsilon
-    of the correct side of the hyperplane.  Important for stop condition.
+############################################################
+#Preliminaries
+############################################################
 
-    This is for the negative examples I_minus.
 
-    :param x_k: the k-th elem of x (neg ex)
-    :param p: params dict of alphas & letters
-    :returns type float: the m_i value
+def init_data(args, scaling=None):
     """
+    Initialize the preliminaries for S-K algo learning of SVM
 
-    #D_i = poly_kernel(p['x_i'], x_k)
-    #E_i = poly_kernel(p['x_j'], x_k)
-    D_i = p['D'][ind]
-    E_i = p['E'][ind]
+    Cards are read from the folder's card cache when it is up to date
+    (see card_cache.py), so no PNG has to be decoded. The X's are float32
+    with --dtype float32; the centroids & lambda are always float64.
 
-    m_i_num = float(-D_i + E_i + p['A'] - p['C'])
-    try:
-        m_i_denom = math.sqrt(p['A'] + p['B'] -2*p['C'])
-    except ValueError:
-        raise Exception('Check the stop condition denom for m_j')
+    With --binary, the cards are bit-packed instead (see bitpack.py) and
+    kept unscaled, positives stacked over negatives, as 'cards'; there
+    are no X's (see unpack_inputs).
 
-    return m_i_num/m_i_denom
+    :param args: the CLARGS from user input
+    :param scaling: (lambda, m_plus, m_minus) to scale with; calculated from the cards if not given
+    :returns type dict: The dict of X's, I's, Y's (all +/-'s)
+    """
 
+    pixels, labels, indices = load_input_cards(args)
 
-############################################################
-#Preliminaries
-############################################################
+    return inputs_from_cards(pixels, labels, indices, args, scaling)
 
 
-def init_data(args):
+def inputs_from_cards(pixels, labels, indices, args, scaling=None):
     """
-    Initialize the preliminaries for S-K algo learning of SVM
+    The input data of init_data, from cards already loaded (e.g. the
+    training rows of a cross-validation fold).
 
+    :param pixels: (n x 625) uint8 cards
+    :param labels: ord() of the letter of every card
+    :param indices: the index of every card
     :param args: the CLARGS from user input
+    :param scaling: (lambda, m_plus, m_minus) to scale with; calculated from the cards if not given
     :returns type dict: The dict of X's, I's, Y's (all +/-'s)
     """
 
-    img_dir = os.path.join(args.train_folder_name, '*.png')
+    is_plus = labels == ord(args.class_letter.upper())
+
+    I_plus = [str(ind) for ind in indices[is_plus]]
+    I_minus = [str(ind) for ind in indices[~is_plus]]
 
-    X_plus = []
-    X_minus = []
-    I_plus = []
-    I_minus = []
+    if len(I_plus) < 1 or len(I_minus) < 1:
+        raise Exception('NO DATA')
 
-    for img_path in glob.glob(img_dir):
-        f_name = os.path.splitext(os.path.basename(img_path))
-        ind, letter = f_name[0].split('_')
+    dtype = np.dtype(getattr(args, 'dtype', 'float64'))
+    ret = {
+        'I_plus': I_plus,
+        'I_minus': I_minus,
+        'class_letter': args.class_letter.upper(),
+        'kernel': kernel_from_args(args).spec,
+        'dtype': dtype.name
+    }
 
-        if letter.upper() == args.class_letter.upper():
-            X_plus.append(rep_data(img_path))
-            I_plus.append(ind)
-        else:
-            X_minus.append(rep_data(img_path))
-            I_minus.append(ind)
+    if getattr(args, 'binary', False):
+        order = np.concatenate((np.flatnonzero(is_plus), np.flatnonzero(~is_plus)))
+        cards = PackedCards.from_pixels(pixels[order], dtype)
+        del pixels
 
-    if len(X_plus) < 1 or len(X_minus) < 1:
-        raise Exception('NO DATA')
+        if scaling is None:
+            stats = cards.hull_stats(np.arange(len(cards)) < len(I_plus))
+            scaling = stats.lam, stats.m_plus, stats.m_minus
+            print('lambda = {}'.format(stats.lam))
 
-    if len(X_plus) != len(I_plus) or len(X_minus) != len(I_minus):
-        raise Exception('[ERROR] Init filter is not working')
+        ret['cards'] = cards
+        ret['lambda'], ret['m_plus'], ret['m_minus'] = scaling
 
-    # TODO scaled to lambda
-    X_plus, X_minus = scale_inputs(X_plus, X_minus)
+        print('Data inputs initialized ({} cards in {:.1f} MB)'.format(len(cards), cards.nbytes / 2.0**20))
+        return ret
 
-    ret = {
+    # Stack into (n x d) matrices normalized to 1's for white; 0's otherwise
+    # (the cards stay uint8 until here)
+    X_plus = pixels[is_plus].astype(dtype)
+    X_plus /= 255
+    X_minus = pixels[~is_plus].astype(dtype)
+    X_minus /= 255
+
+    # Scale to lambda in place
+    lam, m_plus, m_minus = scaling or calc_lambda(X_plus, X_minus)
+    X_plus, X_minus = scale_inputs(X_plus, X_minus, (lam, m_plus, m_minus))
+
+    ret.update({
         'X_plus': X_plus,
         'X_minus': X_minus,
-        'I_plus': I_plus,
-        'I_minus': I_minus
-    }
+        'lambda': lam,
+        'm_plus': m_plus,
+        'm_minus': m_minus
+    })
 
     print('Data inputs initialized')
 
     return ret  # Vectors in X by class and index
 
 
+def unpack_inputs(data, pos_plus=slice(None), pos_minus=slice(None)):
+    """
+    Unpack & scale bit-packed cards (see init_data with --binary).
+
+    :param data: the input data dict, with its cards
+    :param pos_plus: positions of the positive examples to unpack (all by default)
+    :param pos_minus: positions of the negative examples to unpack (all by default)
+    :returns type tuple: the scaled X_plus & X_minus
+    """
+    cards = data['cards']
+    n_plus = len(data['I_plus'])
+
+    X_plus = cards.unpack(np.arange(n_plus)[pos_plus])
+    X_minus = cards.unpack(np.arange(n_plus, len(cards))[pos_minus])
+
+    return scale_inputs(X_plus, X_minus, (data['lambda'], data['m_plus'], data['m_minus']))
+
+
+def support_vector_data(params, data):
+    """
+    Reduce a model trained on bit-packed cards to its support vectors, so
+    only they are unpacked (see svm_model.compact_model).
+
+    :param params: the trained SKState
+    :param data: the input data dict, with its cards
+    :returns type tuple: params & input data dicts of the support vectors
+    """
+    sv_i = np.flatnonzero(params.alpha_i)
+    sv_j = np.flatnonzero(params.alpha_j)
+
+    sv_data = {k: v for k, v in data.items() if k != 'cards'}
+    sv_data['X_plus'], sv_data['X_minus'] = unpack_inputs(data, sv_i, sv_j)
+    sv_data['I_plus'] = np.asarray(data['I_plus'])[sv_i]
+    sv_data['I_minus'] = np.asarray(data['I_minus'])[sv_j]
+
+    sv_params = {
+        'alpha_i': params.alpha_i[sv_i],
+        'alpha_j': params.alpha_j[sv_j],
+        'A': params.A,
+        'B': params.B,
+        'C': params.C
+    }
+
+    return sv_params, sv_data
+
+
 ############################################################
 #S-K Algo Core Logic
 ############################################################
 
 
-def sk_init(data, i=0):
+class SKState(object):
+    """
+    Trainer state of the S-K algorithm, held in contiguous arrays.
+
+    D & E are indexed by row in X_plus stacked over X_minus, i.e. positive
+    example k is row k and negative example k is row n_plus + k.
+    """
+    __slots__ = (
+        'alpha_i', 'alpha_j', 'A', 'B', 'C', 'D', 'E',
+        'I_plus', 'I_minus', 'n_plus', 'i', 'j'
+    )
+
+    def __init__(self, alpha_i, alpha_j, A, B, C, D, E, I_plus, I_minus, i=0, j=0):
+        self.alpha_i = alpha_i  # positive weights
+        self.alpha_j = alpha_j  # negative weights
+        self.A = A
+        self.B = B
+        self.C = C
+        self.D = D  # D[k] = sum_i alpha_i K(x_i, x_k)
+        self.E = E  # E[k] = sum_j alpha_j K(x_j, x_k)
+        self.I_plus = I_plus  # filename index of every positive example
+        self.I_minus = I_minus  # filename index of every negative example
+        self.n_plus = len(alpha_i)
+        self.i = i  # position of the initial positive guess
+        self.j = j  # position of the initial negative guess
+
+    def row(self, category, pos):
+        """
+        :param category: 'pos' or 'neg'
+        :param pos: position of the example within X_plus or X_minus
+        :returns type int: the row of the example in the stacked arrays
+        """
+        return pos if category == 'pos' else self.n_plus + pos
+
+    def as_dict(self):
+        """
+        :returns type dict: the state as a plain dict of alphas, A~E & indices
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def sk_init(data, gram, i=0):
     """
     Step 1: Initialization of s-k algo for kernel version.
     Defines alpha_i & alpha_j, along with A~E.
 
     :param input_data: the dict input data for +/-'s.
-    :returns type dict: pos_ex, neg_ex, alphas, & letters
+    :param gram: the GramMatrix of X_plus stacked over X_minus
+    :returns type SKState: alphas, A~E & index maps
     """
-    ret = {}
+    n_plus = len(data['I_plus'])
 
     # Define alpha (alpha_i = pos weights, alpha_j = neg weights)
-    alpha_i = np.zeros(len(data['X_plus']), dtype=np.int)
-    alpha_j = np.zeros(len(data['X_minus']), dtype=np.int)
-
-    # Positive ex (any vector in X+, default is index 0)
-    x_i1 = data['X_plus'][i]
-    i1 = data['I_plus'][i]
-
-    # Negative ex (any vector in X-, default is index 0)
-    x_j1 = data['X_minus'][i]
-    j1 = data['I_minus'][i]
+    alpha_i = np.zeros(len(data['I_plus']), dtype=np.float64)
+    alpha_j = np.zeros(len(data['I_minus']), dtype=np.float64)
 
     # Set alpha's to one for support vector "guesses"
+    # (x_i1 = X_plus[i] and x_j1 = X_minus[i], default is index 0)
     alpha_i[i] = 1
     alpha_j[i] = 1
 
+    # Rows of x_i1 & x_j1 in the Gram matrix
+    K_i1 = gram.row(i)
+    K_j1 = gram.row(n_plus + i)
+
     # Define A~C
-    A = poly_kernel(x_i1, x_i1)
-    B = poly_kernel(x_j1, x_j1)
-    C = poly_kernel(x_i1, x_j1)
+    A = float(K_i1[i])
+    B = float(K_j1[n_plus + i])
+    C = float(K_i1[n_plus + i])
 
     # Define D & E for all i in I, x_i in X
-    D = {}
-    E = {}
-    for ind, x_i in zip(data['I_plus'], data['X_plus']):
-        D[ind] = poly_kernel(x_i, x_i1)
-        E[ind] = poly_kernel(x_i, x_j1)
+    D = np.array(K_i1, dtype=np.float64)
+    E = np.array(K_j1, dtype=np.float64)
 
-    for ind, x_i in zip(data['I_minus'], data['X_minus']):
-        D[ind] = poly_kernel(x_i, x_i1)
-        E[ind] = poly_kernel(x_i, x_j1)
+    return SKState(
+        alpha_i, alpha_j, A, B, C, D, E,
+        np.asarray(data['I_plus']), np.asarray(data['I_minus']),
+        i=i, j=i
+    )
 
-    # Add to dict
-    ret = {
-        'x_i': x_i1,
-        'i': i1,
-        'x_j': x_j1,
-        'j': j1,
-        'alpha_i': alpha_i,
-        'alpha_j': alpha_j,
-        'A': A,
-        'B': B,
-        'C': C,
-        'D': D,
-        'E': E
-    }
 
-    return ret
+def load_warm_start(filename, class_letter):
+    """
+    Load the model of a class to warm-start training from.
 
+    :param filename: a pickled or compact model, or a one-vs-rest bundle
+    :param class_letter: the class being trained
+    :returns type dict: the model params
+    """
+    model = load_model(filename)
+    if 'models' in model:
+        if class_letter not in model['models']:
+            raise Exception('No {} model in {}'.format(class_letter, filename))
+        model = model['models'][class_letter]
+
+    if model.get('class_letter') not in (None, class_letter):
+        raise Exception('{} is a {} model, not {}'.format(filename, model['class_letter'], class_letter))
+
+    return model
 
-def should_stop(d, p, epsilon):
+
+def warm_scaling(model):
     """
-    Determine whether to stop or continue.
+    :param model: the model params to warm-start from
+    :returns type tuple: its (lambda, m_plus, m_minus)
+    """
+    return (
+        float(model['lambda']),
+        np.asarray(model['m_plus'], dtype=np.float64),
+        np.asarray(model['m_minus'], dtype=np.float64)
+    )
 
-    :param d: the input data dict of X's & I's
-    :param p: dict of alphas & letters
-    :epsilon: error tolerance defined in CLARGS
-    :returns type bool: True if stop condition met; otherwise, False
+
+def _find_rows(I, I_model, category):
+    """
+    :param I: the filename index of every example of a class
+    :param I_model: the filename indices of some examples of the model
+    :param category: 'pos' or 'neg', for the error message
+    :returns numpy array: the position in I of every index of I_model
     """
+    positions = {str(ind): k for k, ind in enumerate(I)}
+    try:
+        return np.array([positions[str(ind)] for ind in I_model], dtype=np.int64)
+    except KeyError as e:
+        raise Exception('Support vector {} of the warm-start model is not a {} example'.format(e, category))
+
 
+def sk_warm_init(data, model):
     """
-    Get min vals
-    NB: m_is & m_js are indexed by their m-values and store
-    their corresponding indices as well as x_vector.
+    Step 1, seeded from a previously trained model instead of one guess per
+    class, e.g. after adding cards to the training folder.
+
+    The data must be scaled with the model's lambda & centroids (see
+    warm_scaling) so that its support vectors keep their scaled positions.
+    A~C come from the kernel matrix of the support vectors; D & E are
+    reused for examples the model was trained on (pickled models only), so
+    kernel terms are computed only for the new examples.
+
+    :param data: the dict input data for +/-'s, with the kernel spec
+    :param model: the model params to warm-start from (see load_warm_start)
+    :returns type SKState: alphas, A~E & index maps
     """
-    m_is = {}
-    for pos_ex, pos_ind in zip(d['X_plus'], d['I_plus']):
-        m_i = calc_mi(pos_ex, p, pos_ind)
-        m_is[m_i] = {
-            'ind': pos_ind,
-            'x': pos_ex
-        }
+    kernel = kernel_from_spec(data.get('kernel'))
+    X_plus = data['X_plus']
+    X_minus = data['X_minus']
+    n_plus = len(data['I_plus'])
+    I_plus = np.asarray(data['I_plus'])
+    I_minus = np.asarray(data['I_minus'])
+
+    # Support vectors of the model, found among the examples by filename index
+    sv = support_vectors(model)
+    rows_i = _find_rows(I_plus, sv['I_plus'], 'pos')
+    rows_j = _find_rows(I_minus, sv['I_minus'], 'neg')
+
+    if not (np.allclose(X_plus[rows_i], sv['X_plus'], atol=1e-5)
+            and np.allclose(X_minus[rows_j], sv['X_minus'], atol=1e-5)):
+        raise Exception('Support vectors of the warm-start model do not match the training cards')
+
+    # Only pickled models have D & E (and float64 alphas that still sum to 1)
+    has_DE = 'D' in model and 'E' in model
+    a = np.asarray(sv['alpha_i'], dtype=np.float64)
+    b = np.asarray(sv['alpha_j'], dtype=np.float64)
+    if not has_DE:
+        a /= a.sum()
+        b /= b.sum()
+
+    alpha_i = np.zeros(n_plus, dtype=np.float64)
+    alpha_j = np.zeros(len(I_minus), dtype=np.float64)
+    alpha_i[rows_i] = a
+    alpha_j[rows_j] = b
 
-    m_js = {}
-    for neg_ex, neg_ind in zip(d['X_minus'], d['I_minus']):
-        m_j = calc_mj(neg_ex, p, neg_ind)
-        m_js[m_j] = {
-            'ind': neg_ind,
-            'x': neg_ex
-        }
+    # Define A~C
+    X_i = X_plus[rows_i]
+    X_j = X_minus[rows_j]
+    A = float(np.dot(a, np.dot(kernel.matrix(X_i), a)))
+    B = float(np.dot(b, np.dot(kernel.matrix(X_j), b)))
+    C = float(np.dot(a, np.dot(kernel.matrix(X_i, X_j), b)))
+
+    # Define D & E, reusing the model's for the examples it already has
+    X = np.vstack((X_plus, X_minus))
+    D = np.empty(len(X), dtype=np.float64)
+    E = np.empty(len(X), dtype=np.float64)
+    new = np.ones(len(X), dtype=bool)
+
+    if has_DE:
+        old_plus = {str(ind): k for k, ind in enumerate(model['I_plus'])}
+        old_minus = {str(ind): k + len(old_plus) for k, ind in enumerate(model['I_minus'])}
+        for k, ind in enumerate(np.concatenate((I_plus, I_minus))):
+            old = (old_plus if k < n_plus else old_minus).get(str(ind))
+            if old is not None:
+                D[k] = model['D'][old]
+                E[k] = model['E'][old]
+                new[k] = False
+
+    rows = np.flatnonzero(new)
+    for start in range(0, len(rows), 1024):
+        block = rows[start:start + 1024]
+        D[block] = np.dot(kernel.matrix(X[block], X_i), a)
+        E[block] = np.dot(kernel.matrix(X[block], X_j), b)
+
+    print('Warm start from {} support vectors, {} new examples'.format(len(a) + len(b), len(rows)))
+
+    return SKState(
+        alpha_i, alpha_j, A, B, C, D, E,
+        I_plus, I_minus,
+        i=int(rows_i[np.argmax(a)]), j=int(rows_j[np.argmax(b)])
+    )
+
+
+def should_stop(d, s, epsilon, stop=None):
+    """
+    Determine whether to stop or continue.
+
+    :param d: the input data dict of X's & I's
+    :param s: SKState of alphas & kernel quantities
+    :epsilon: error tolerance defined in CLARGS
+    :param stop: the StopCondition evaluating the margins (a serial one if not given)
+    :returns type bool: True if stop condition met; otherwise, False
+    """
 
-    m_i_min = min(m_is.keys())
-    m_j_min = min(m_js.keys())
+    # Get min val of all margins
+    stop = stop or StopCondition(s.n_plus, len(s.D), workers=1)
+    t_row, m_t, denom = stop.closest(s)
 
     # Define x_t (vector closest to hyperplane) and its corresponding metadata
-    if m_is[m_i_min] < m_js[m_j_min]:
+    if t_row < s.n_plus:
         ret = {
             'category': 'pos',  # positive category
-            'm_t': m_i_min,  # see calc_mi
-            't_ind': m_is[m_i_min]['ind'],  # index val of min
-            'x_t': m_is[m_i_min]['x']  # support vector
+            'm_t': m_t,  # see stop_condition.py
+            't_ind': s.I_plus[t_row],  # index val of min
+            't_pos': t_row  # position of min in X_plus
         }
     else:
         ret = {
             'category': 'neg',  # negative category
-            'm_t': m_j_min,  # see calc_mi
-            't_ind': m_js[m_j_min]['ind'],  # index val of min
-            'x_t': m_js[m_j_min]['x']  # support vector
+            'm_t': m_t,  # see stop_condition.py
+            't_ind': s.I_minus[t_row - s.n_plus],  # index val of min
+            't_pos': t_row - s.n_plus  # position of min in X_minus
         }
 
     # Calc deltas
-    err_msg = 'Attempted negative sqrt for {} ex stop condition check'
-    try:
-        m_delta = math.sqrt(p['A'] + p['B'] - 2*p['C']) - ret['m_t']
-    except ValueError:
-        raise Exception(err_msg.format(ret))
+    m_delta = denom - ret['m_t']
+    ret['m_delta'] = m_delta
 
     # Compare to epsilon
     if m_delta < epsilon:
@@ -327,99 +477,132 @@ def should_stop(d, p, epsilon):
     return False, ret
 
 
-def adapt(d, p, x_t):
+def adapt(d, s, x_t, gram):
     """
+    Step 2: Update the state in place towards x_t.
+
     :param d: input data dict of X's & I's from sample space
-    :param p: params dict of alphas & letters
-    :returns type dict: new dict of alphs & letters params
+    :param s: SKState of alphas & kernel quantities
+    :param x_t: the dict of the vector closest to the hyperplane (see should_stop)
+    :param gram: the GramMatrix of X_plus stacked over X_minus
+    :returns type SKState: the updated state
     """
 
-    A = p['A']
-    B = p['B']
-    C = p['C']
-    D = p['D']
-    E = p['E']
+    A = s.A
+    B = s.B
+    C = s.C
 
-    t = x_t['t_ind'] # Index of vector closest to hyperplane
+    # Row of x_t in the Gram matrix, i.e. K(x_t, x) for all x
+    t_pos = x_t['t_pos']
+    t = s.row(x_t['category'], t_pos)
+    K_t = gram.row(t)
+    K_tt = gram.diag[t]
 
-    try:
-        D_t = D[t]
-        E_t = E[t]
-    except KeyError:
-        raise Exception('FATAL ERROR! CHECK YOUR INPUT LOGIC!!')
-
-    delta_i_t = lambda i, t: 1 if i == t else 0
+    D_t = s.D[t]
+    E_t = s.E[t]
 
     if x_t['category'] == 'pos':
         # logic for positive ex, i.e. if x_t is from positive examples
-        q_num = float( A - D_t + E_t - C)
-        q_denom = A + poly_kernel(x_t['x_t'], x_t['x_t']) - 2 * (D_t - E_t)
-        q = q_num/q_denom
+        q_num = float(A - D_t + E_t - C)
+        q_denom = A + K_tt - 2 * (D_t - E_t)
+        q = min(1, q_num/q_denom)
 
         # Adapt positive alphas (coefficients)
-        old_alpha = p['alpha_i'] 
-        new_alpha = np.zeros(old_alpha.shape)
-
-        for i, a_i in enumerate(old_alpha):
-            new_alpha[i] = (1 - q) * old_alpha[i] + q * delta_i_t(i, t)
-
-        # Update alpha_i
-        p['alpha_i'] = new_alpha
+        s.alpha_i *= (1 - q)
+        s.alpha_i[t_pos] += q
 
         # Update kernel functions
-        p['A'] = A * (1 - q)**2 + 2 * (1 - q) * q * D_t + q**2 * poly_kernel(x_t['x_t'], x_t['x_t'])
-        p['C'] = (1 - q) * C + q * E_t
-
-        # Update D and add back to params dict
-        for ind, D_i in D.items():
-            D[ind] = (1 - q)*D_i + q*poly_kernel(x_t['x_t'], x_t['x_t'])
-
-        p['D'] = D
+        s.A = A * (1 - q)**2 + 2 * (1 - q) * q * D_t + q**2 * K_tt
+        s.C = (1 - q) * C + q * E_t
 
+        # Update D
+        s.D *= (1 - q)
+        s.D += q * K_t
 
     elif x_t['category'] == 'neg':
         # logic for negative ex, i.e. if x_t is from negative examples
         q_num = float(B - E_t + D_t - C)
-        q_denom = B + poly_kernel(x_t['x_t'], x_t['x_t']) - 2 * (E_t - D_t)
-        q = q_num/q_denom
-
-        # Adapt positive alphas (coefficients)
-        old_alpha = p['alpha_j'] 
-        new_alpha = np.zeros(old_alpha.shape)
-
-        for j, a_i in enumerate(old_alpha):
-            new_alpha[j] = (1 - q) * old_alpha[j] + q * delta_i_t(j, t)
+        q_denom = B + K_tt - 2 * (E_t - D_t)
+        q = min(1, q_num/q_denom)
 
-        # Update alpha_i
-        p['alpha_j'] = new_alpha
+        # Adapt negative alphas (coefficients)
+        s.alpha_j *= (1 - q)
+        s.alpha_j[t_pos] += q
 
         # Update kernel functions
-        p['B'] = B * (1 - q)**2 + 2 * (1 - q) * q * E_t + q**2 * poly_kernel(x_t['x_t'], x_t['x_t'])
-        p['C'] = (1 - q) * C + q * D_t
+        s.B = B * (1 - q)**2 + 2 * (1 - q) * q * E_t + q**2 * K_tt
+        s.C = (1 - q) * C + q * D_t
 
         # Update E
-        for ind, E_i in E.items():
-            E[ind] = (1 - q)*E_i + q*poly_kernel(x_t['x_t'], x_t['x_t'])
+        s.E *= (1 - q)
+        s.E += q * K_t
 
-        p['E'] = E
+    return s
 
-    return p
 
+def kernel_storage(args, warm_start=False):
+    """
+    :param args: the CLARGS from user input
+    :param warm_start: True if training starts from a previous model
+    :returns type str: the --kernel-storage asked for; if none, lru for a warm start
+        (only the rows it touches are computed) and memory otherwise
+    """
+    storage = getattr(args, 'kernel_storage', None)
+    if storage is None:
+        storage = 'lru' if warm_start else 'memory'
+    return storage
 
-def sk_algorithm(input_data, args):
+
+def sk_algorithm(input_data, args, gram=None, warm_model=None, monitor=None):
     """
     Find support vectors of scaled convex hulls for X+ & X-.
 
-    :param x: the input numpy vector from an img
+    :param input_data: the dict of (scaled) X's & I's, with the kernel spec
     :args: the CLARGS from user input
-    :returns type dict: final dict of alphas and letters
+    :param gram: kernel rows of X_plus stacked over X_minus; a GramMatrix is built if not given
+    :param warm_model: model params to start from instead of sk_init (see sk_warm_init)
+    :param monitor: the TrainingMonitor of the run, closed at the end; made from args if not given
+    :returns type SKState: final state of alphas and kernel quantities
     """
-    # TODO implement scaling logic (need to return lambda and centroids for serialization)
-
-    # Initialization
-    params = sk_init(input_data)
+    owns_gram = gram is None
+    monitor = monitor or TrainingMonitor.from_args(args, input_data.get('class_letter'))
+
+    # Kernel matrix of X_plus stacked over X_minus, computed once up front
+    # (or row by row on demand, with an LRU cache; bit-packed cards are
+    # always row by row, from popcounts)
+    storage = kernel_storage(args, warm_model is not None)
+    if owns_gram:
+        with monitor.phase('kernel_matrix'):
+            kernel = kernel_from_spec(input_data.get('kernel'))
+            if 'cards' in input_data:
+                cards = input_data['cards']
+                gram = ScaledGram(
+                    cards, cards, np.arange(len(cards)), len(input_data['I_plus']),
+                    input_data['lambda'], input_data['m_plus'], input_data['m_minus'], kernel)
+                if storage == 'lru':
+                    gram = KernelRowCache(gram.row, gram.diag, args.kernel_cache_mb, gram.dtype.itemsize)
+            elif storage == 'lru':
+                X = np.vstack((input_data['X_plus'], input_data['X_minus']))
+                gram = KernelRowCache.for_inputs(X, kernel, args.kernel_cache_mb)
+            else:
+                X = np.vstack((input_data['X_plus'], input_data['X_minus']))
+                gram = GramMatrix(X, kernel, storage, args.kernel_block_size)
+    gram = monitor.wrap(gram)
+
+    # Initialization, or the state of an interrupted run
+    checkpointer = Checkpointer.from_args(args, input_data.get('class_letter'))
+    start = 0
+    with monitor.phase('init'):
+        if getattr(args, 'resume', False) and checkpointer.exists():
+            params, start = load_checkpoint(checkpointer.path, input_data, SKState)
+            print('Resumed from {} at step {}'.format(checkpointer.path, start))
+        elif warm_model is not None:
+            params = sk_warm_init(input_data, warm_model)
+        else:
+            params = sk_init(input_data, gram)
+    stop = StopCondition.from_args(args, params.n_plus, len(params.D))
 
-    for i in xrange(int(args.max_updates)): # If max num of updates reached before err < epsilon, stop
+    for i in range(start, int(args.max_updates)): # If max num of updates reached before err < epsilon, stop
 
         # Print alphas & letters on every 1000th step
         if i % 1000 == 0:
@@ -427,14 +610,32 @@ def sk_algorithm(input_data, args):
             #print params
 
         # Check for stop condition
-        is_done, x_t = should_stop(input_data, params, args.epsilon)
+        with monitor.phase('should_stop'):
+            is_done, x_t = should_stop(input_data, params, args.epsilon, stop)
+        monitor.step(i, params, x_t['m_delta'])
         if is_done:
             print('Completed training at step {step}'.format(step=i))
-            return params
+            break
 
-        params = adapt(input_data, params, x_t)
+        with monitor.phase('adapt'):
+            params = adapt(input_data, params, x_t, gram)
+        with monitor.phase('checkpoint'):
+            checkpointer.maybe_save(params, i + 1, input_data)
+    else:
+        i = int(args.max_updates)
+        print('\nTrained for {}'.format(args.max_updates))
+
+    # Final state, so a run can be resumed with a larger max_updates
+    if checkpointer.enabled:
+        with monitor.phase('checkpoint'):
+            checkpointer.save(params, i, input_data)
 
-    print('\nTrained for {}'.format(args.max_updates))
+    if hasattr(gram, 'report'):
+        print(gram.report())
+    print(monitor.report(monitor.close(params, gram)))
+    stop.close()
+    if owns_gram:
+        gram.close()
 
     return params
 
@@ -448,7 +649,7 @@ def serialize_model(params, input_data, filename):
     :returns type bool: True if write succeeds; otherwise, False
     '''
 
-    model = params
+    model = params.as_dict() if isinstance(params, SKState) else params
 
     for k, v in input_data.items():
         model[k] = v
@@ -460,26 +661,6 @@ def serialize_model(params, input_data, filename):
     return False
 
 
-############################################################
-#Reading in the data
-############################################################
-
-
-def rep_data(img_path):
-    """
-    The contents of this image as a sequence object containing pixel values. The sequence object is flattened, so that values for line one follow directly after the values of line zero, and so on.
-
-    Note that the sequence object returned by this method is an internal PIL data type, which only supports certain sequence operations. To convert it to an ordinary sequence (e.g. for printing), use list(im.getdata()).
-
-    :param img_path: the path to image file
-    :returns numpy arrays: A vector representation of the image.
-    """
-    img = Image.open(img_path)
-    arr = np.array(list(img.getdata()), int)
-
-    return arr/255 # normalize to 1's for white; 0's otherwise
-
-
 ############################################################
 #CLARGS
 ############################################################
@@ -502,7 +683,7 @@ parser.add_argument(
 )
 parser.add_argument(
     'class_letter',
-    help='Specify the class letter [P, W, Q, S].'
+    help='Specify the class letter [P, W, Q, S], or ALL to train one-vs-rest classifiers for every class.'
 )
 parser.add_argument(
     'model_file_name',
@@ -510,21 +691,204 @@ parser.add_argument(
 )
 parser.add_argument(
     'train_folder_name',
-    help='Locating of training data.'
+    nargs='?',
+    help='Locating of training data (a folder or .npz shard).'
+)
+parser.add_argument(
+    '--generate',
+    type=int,
+    default=None,
+    metavar='N',
+    help='Train on N cards generated in memory instead of train_folder_name.'
+)
+parser.add_argument(
+    '--generate-seed',
+    type=int,
+    default=None,
+    help='Seed for the generated cards (default: unseeded).'
+)
+parser.add_argument(
+    '--model-format',
+    choices=['pickle', 'compact'],
+    default='pickle',
+    help='Save the full pickled model, or only its support vectors (default: pickle).'
+)
+parser.add_argument(
+    '--kernel-storage',
+    choices=STORAGE_MODES,
+    default=None,
+    help='Where to keep the precomputed kernel matrix (default: memory; lru, rows on demand, with --warm-start).'
+)
+parser.add_argument(
+    '--kernel-block-size',
+    type=int,
+    default=1024,
+    help='Rows of the kernel matrix computed per block (default: 1024).'
+)
+parser.add_argument(
+    '--kernel-cache-mb',
+    type=float,
+    default=DEFAULT_CACHE_MB,
+    help='Memory budget of the kernel row cache with --kernel-storage lru (default: {}).'.format(DEFAULT_CACHE_MB)
+)
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=os.cpu_count(),
+    help='Processes training one-vs-rest classifiers with ALL, or folds with --k-fold, in parallel (default: all cores).'
+)
+parser.add_argument(
+    '--k-fold',
+    type=int,
+    default=0,
+    metavar='K',
+    help='Report K-fold cross-validated accuracy instead of saving a model (the cards are loaded once).'
+)
+parser.add_argument(
+    '--split-seed',
+    type=int,
+    default=None,
+    help='Seed for assigning cards to folds (default: unseeded).'
+)
+parser.add_argument(
+    '--stop-workers',
+    type=int,
+    default=STOP_WORKERS,
+    help='Threads evaluating the stop condition, one chunk of examples each (default: {}).'.format(STOP_WORKERS)
+)
+parser.add_argument(
+    '--stop-chunk-size',
+    type=int,
+    default=DEFAULT_CHUNK_SIZE,
+    help='Examples per chunk of the stop condition (default: {}).'.format(DEFAULT_CHUNK_SIZE)
+)
+add_kernel_args(parser)
+parser.add_argument(
+    '--binary',
+    action='store_true',
+    default=False,
+    help='Bit-pack the (black & white) cards and compute kernel rows from popcounts.'
+)
+parser.add_argument(
+    '--dtype',
+    choices=DTYPES,
+    default='float64',
+    help='Precision of the inputs & kernel values; float32 halves their memory (default: float64).'
+)
+parser.add_argument(
+    '--warm-start',
+    default=None,
+    metavar='MODEL_FILE',
+    help='Start from the alphas of a previous model of the class (its lambda, centroids & kernel are reused; '
+         'kernel rows are computed on demand unless --kernel-storage is given).'
+)
+parser.add_argument(
+    '--metrics',
+    default=None,
+    metavar='FILE',
+    help='Trace timings, kernel rows, m_delta & memory to FILE as JSON lines (CSV if FILE ends in .csv).'
+)
+parser.add_argument(
+    '--metrics-every',
+    type=int,
+    default=100,
+    help='Trace every N training steps (default: 100).'
+)
+parser.add_argument(
+    '--profile',
+    default=None,
+    metavar='FILE',
+    help='Run under cProfile and write its stats to FILE (see pstats).'
+)
+parser.add_argument(
+    '--trace-memory',
+    action='store_true',
+    default=False,
+    help='Also trace the peak of Python allocations with tracemalloc (slower).'
+)
+parser.add_argument(
+    '--checkpoint',
+    default=None,
+    help='Checkpoint file of the trainer state (default: <model_file_name>.ckpt).'
+)
+parser.add_argument(
+    '--checkpoint-every',
+    type=int,
+    default=0,
+    help='Checkpoint every N training steps (default: never).'
+)
+parser.add_argument(
+    '--checkpoint-seconds',
+    type=float,
+    default=0,
+    help='Checkpoint when T seconds have passed since the last checkpoint (default: never).'
+)
+parser.add_argument(
+    '--resume',
+    action='store_true',
+    default=False,
+    help='Continue from the checkpoint, if there is one.'
 )
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-
-    # Init
-    input_data = init_data(args)  # dict of input data
+    args.kernel_storage = kernel_storage(args, args.warm_start is not None)
+
+    # Cross-validated accuracy of one class, instead of a model
+    if args.k_fold:
+        if args.class_letter.upper() == 'ALL':
+            raise Exception('--k-fold cross-validates a single class, not ALL')
+        if args.warm_start is not None:
+            raise Exception('--k-fold trains every fold from scratch; drop --warm-start')
+
+        from sk_cross_validation import cross_validate
+        from cross_validation import report
+
+        print(report(cross_validate(args)))
+        sys.exit(0)
+
+    # One-vs-rest for every class, saved as one compact bundle
+    if args.class_letter.upper() == 'ALL':
+        if args.warm_start is not None:
+            raise Exception('--warm-start trains a single class, not ALL')
+
+        from sk_multiclass import train_one_vs_rest
+
+        if export_bundle(train_one_vs_rest(args), args.model_file_name):
+            print('Model saved to {}'.format(args.model_file_name))
+        sys.exit(0)
+
+    monitor = TrainingMonitor.from_args(args)
+
+    # Init (a warm start keeps the scaling & kernel of its model)
+    warm_model = None
+    with monitor.phase('load'):
+        if args.warm_start is not None:
+            if args.binary:
+                raise Exception('--warm-start needs the unpacked cards; drop --binary')
+            warm_model = load_warm_start(args.warm_start, args.class_letter.upper())
+            input_data = init_data(args, warm_scaling(warm_model))
+            input_data['kernel'] = warm_model.get('kernel')
+        else:
+            input_data = init_data(args)  # dict of input data
 
     # Run algo
-    params = sk_algorithm(input_data, args)  # dict of model params
+    params = sk_algorithm(input_data, args, warm_model=warm_model, monitor=monitor)  # dict of model params
+
+    # Write model to file (only the support vectors of packed cards are unpacked,
+    # unless the full model is pickled)
+    if args.model_format == 'compact':
+        if 'cards' in input_data:
+            params, input_data = support_vector_data(params, input_data)
+        saved = export_compact_model(params, input_data, args.model_file_name)
+    else:
+        if 'cards' in input_data:
+            input_data['X_plus'], input_data['X_minus'] = unpack_inputs(input_data)
+            del input_data['cards']
+        saved = serialize_model(params, input_data, args.model_file_name)
 
-    # Write model to file
-    if serialize_model(params, input_data, args.model_file_name):
+    if saved:
         print('Model saved to {}'.format(args.model_file_name))
 
     print('\n Final output:  ')
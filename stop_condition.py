@@ -0,0 +1,126 @@
+"""
+Vectorized evaluation of the S-K stop condition.
+
+Every example gets its margin from D & E in one expression,
+
+    m_k = (D_k - E_k + B - C) / sqrt(A + B - 2C)    for a positive x_k
+    m_k = (E_k - D_k + A - C) / sqrt(A + B - 2C)    for a negative x_k
+
+with the square root (the same for every example) taken once per step.
+Since it is positive, the example closest to the hyperplane is the one
+with the smallest numerator, so only the minimum is divided. Large
+training sets are split into chunks scanned on a thread pool (numpy
+releases the GIL) and the per-chunk minima are reduced.
+
+:authors Jason, Nick, Sam
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Examples per chunk; smaller training sets are scanned in one pass
+DEFAULT_CHUNK_SIZE = 1 << 18
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class StopCondition(object):
+    """
+    Finds the example x_t closest to the hyperplane, for should_stop.
+    """
+
+    def __init__(self, n_plus, n, chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS):
+        """
+        :param n_plus: the number of positive examples (rows of D & E before the negatives)
+        :param n: the number of examples
+        :param chunk_size: examples per chunk
+        :param workers: threads scanning the chunks (1 to scan them in turn)
+        """
+        self.n_plus = n_plus
+        self.n = n
+        self.chunk_size = max(1, chunk_size)
+
+        # Margin numerators, reused every step
+        self.num = np.empty(n, dtype=np.float64)
+
+        # Chunks never straddle the positives & negatives, so each has one sign
+        self.chunks = [
+            (start, min(start + self.chunk_size, stop), k0 == 0)
+            for k0, stop in ((0, n_plus), (n_plus, n))
+            for start in range(k0, stop, self.chunk_size)
+        ]
+
+        # Threads only pay off when the examples span several chunks
+        self.pool = None
+        if workers > 1 and n > self.chunk_size:
+            self.pool = ThreadPoolExecutor(min(workers, len(self.chunks)))
+
+    @classmethod
+    def from_args(cls, args, n_plus, n):
+        """
+        :param args: the CLARGS from user input
+        :param n_plus: the number of positive examples
+        :param n: the number of examples
+        :returns type StopCondition: the stop condition evaluator of the run
+        """
+        return cls(
+            n_plus, n,
+            getattr(args, 'stop_chunk_size', DEFAULT_CHUNK_SIZE),
+            getattr(args, 'stop_workers', DEFAULT_WORKERS)
+        )
+
+    def _scan(self, chunk, s):
+        """
+        :param chunk: (start, stop, is_plus) of the chunk
+        :param s: the SKState
+        :returns type tuple: the smallest margin numerator of the chunk & its row
+        """
+        start, stop, is_plus = chunk
+        num = self.num[start:stop]
+        if is_plus:
+            np.subtract(s.D[start:stop], s.E[start:stop], out=num)
+            num += s.B - s.C
+        else:
+            np.subtract(s.E[start:stop], s.D[start:stop], out=num)
+            num += s.A - s.C
+        k = int(np.argmin(num))
+        return num[k], start + k
+
+    def closest(self, s):
+        """
+        :param s: the SKState of alphas & kernel quantities
+        :returns type tuple: the row of x_t in X_plus stacked over X_minus, its margin m_t & sqrt(A + B - 2C)
+        """
+        try:
+            denom = math.sqrt(s.A + s.B - 2*s.C)
+        except ValueError:
+            raise Exception('Attempted negative sqrt for the stop condition check')
+
+        if self.pool is not None:
+            minima = list(self.pool.map(lambda chunk: self._scan(chunk, s), self.chunks))
+        else:
+            minima = [self._scan(chunk, s) for chunk in self.chunks]
+
+        # Smallest positive & negative margins; a tie goes to the negative example
+        best = {}
+        for (start, stop, is_plus), (num, row) in zip(self.chunks, minima):
+            if is_plus not in best or num < best[is_plus][0]:
+                best[is_plus] = (num, row)
+
+        m_i, i_row = best[True]
+        m_j, j_row = best[False]
+        if m_i / denom < m_j / denom:
+            return i_row, float(m_i / denom), denom
+        return j_row, float(m_j / denom), denom
+
+    def close(self):
+        """
+        Stop the scanning threads.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
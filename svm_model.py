@@ -0,0 +1,178 @@
+"""
+Compact, memory-mappable file format for trained S-K SVM models.
+
+Only the support vectors (examples with a non-zero alpha) are kept, as
+float32, together with A~C, lambda, the centroids and the kernel. The file is a
+packed array file (see packed.py) whose metadata records the format
+version, so inference cost and load time scale with the number of
+support vectors instead of the size of the training set.
+
+:authors Jason, Nick, Sam
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+from packed import is_packed, read_packed, write_packed
+
+
+MODEL_FORMAT = 'sk-svm'
+BUNDLE_FORMAT = 'sk-svm-ovr'
+MODEL_VERSION = 1
+
+
+def support_vectors(model):
+    """
+    Drop the examples whose alpha is exactly zero.
+
+    :param model: dict with X_plus, X_minus, alpha_i, alpha_j (and optionally I_plus, I_minus)
+    :returns type dict: the same keys, restricted to the support vectors
+    """
+    alpha_i = np.asarray(model['alpha_i'])
+    alpha_j = np.asarray(model['alpha_j'])
+    sv_i = np.flatnonzero(alpha_i)
+    sv_j = np.flatnonzero(alpha_j)
+
+    ret = {
+        'X_plus': np.asarray(model['X_plus'])[sv_i],
+        'X_minus': np.asarray(model['X_minus'])[sv_j],
+        'alpha_i': alpha_i[sv_i],
+        'alpha_j': alpha_j[sv_j]
+    }
+    if 'I_plus' in model and 'I_minus' in model:
+        ret['I_plus'] = np.asarray(model['I_plus'], dtype=np.int64)[sv_i]
+        ret['I_minus'] = np.asarray(model['I_minus'], dtype=np.int64)[sv_j]
+
+    return ret
+
+
+def compact_model(params, input_data):
+    """
+    Reduce a trained model to its compact arrays & metadata.
+
+    :param params: the trained SKState (or its dict)
+    :param input_data: the dict of X's & I's the model was trained on, with lambda & centroids
+    :returns type tuple: dict of float32/int64 arrays, dict of metadata
+    """
+    p = params if isinstance(params, dict) else params.as_dict()
+
+    sv = support_vectors({
+        'X_plus': input_data['X_plus'],
+        'X_minus': input_data['X_minus'],
+        'alpha_i': p['alpha_i'],
+        'alpha_j': p['alpha_j'],
+        'I_plus': input_data['I_plus'],
+        'I_minus': input_data['I_minus']
+    })
+
+    arrays = {
+        'X_plus': sv['X_plus'].astype(np.float32),
+        'X_minus': sv['X_minus'].astype(np.float32),
+        'alpha_i': sv['alpha_i'].astype(np.float32),
+        'alpha_j': sv['alpha_j'].astype(np.float32),
+        'I_plus': sv['I_plus'],
+        'I_minus': sv['I_minus'],
+        'm_plus': np.asarray(input_data['m_plus'], dtype=np.float32),
+        'm_minus': np.asarray(input_data['m_minus'], dtype=np.float32)
+    }
+    meta = {
+        'format': MODEL_FORMAT,
+        'version': MODEL_VERSION,
+        'class_letter': input_data.get('class_letter'),
+        'A': float(p['A']),
+        'B': float(p['B']),
+        'C': float(p['C']),
+        'lambda': float(input_data['lambda']),
+        'kernel': input_data.get('kernel')
+    }
+
+    return arrays, meta
+
+
+def export_compact_model(params, input_data, filename):
+    """
+    Write a trained model in the compact format.
+
+    :param params: the trained SKState (or its dict)
+    :param input_data: the dict of X's & I's the model was trained on, with lambda & centroids
+    :param filename: Name of file to save model in
+    :returns type bool: True if write succeeds; otherwise, False
+    """
+    arrays, meta = compact_model(params, input_data)
+    write_packed(filename, arrays, meta)
+    return True
+
+
+def export_bundle(models, filename):
+    """
+    Write one-vs-rest models, one per class letter, to a single compact file.
+
+    :param models: dict of class letter -> (arrays, meta) from compact_model
+    :param filename: Name of file to save the bundle in
+    :returns type bool: True if write succeeds; otherwise, False
+    """
+    arrays = {}
+    for letter, (model_arrays, _) in models.items():
+        for name, arr in model_arrays.items():
+            arrays['{}/{}'.format(letter, name)] = arr
+
+    meta = {
+        'format': BUNDLE_FORMAT,
+        'version': MODEL_VERSION,
+        'classes': {letter: model_meta for letter, (_, model_meta) in models.items()}
+    }
+
+    write_packed(filename, arrays, meta)
+    return True
+
+
+def load_compact_model(filename):
+    """
+    Open a compact model or bundle; its arrays are memory mapped, not read.
+
+    :param filename: the compact model file
+    :returns type dict: the model params (X's & alphas of the support vectors, A~C, lambda, centroids);
+        for a bundle, {'classes': [letters], 'models': {letter: model params}}
+    """
+    arrays, meta = read_packed(filename)
+
+    if meta.get('format') not in (MODEL_FORMAT, BUNDLE_FORMAT):
+        raise Exception('{} is not an SVM model'.format(filename))
+    if meta.get('version', 0) > MODEL_VERSION:
+        raise Exception('SVM model version {} is not supported'.format(meta['version']))
+
+    if meta['format'] == BUNDLE_FORMAT:
+        models = {}
+        for letter, model_meta in meta['classes'].items():
+            prefix = letter + '/'
+            model = {name[len(prefix):]: arr for name, arr in arrays.items() if name.startswith(prefix)}
+            model.update(model_meta)
+            models[letter] = model
+        return {'classes': sorted(models), 'models': models}
+
+    model = dict(arrays)
+    model.update(meta)
+    return model
+
+
+def load_model(filename):
+    """
+    Load a trained model, either compact or pickled by sk_train.serialize_model.
+
+    :param filename: the model file
+    :returns type dict: the model params
+    """
+    if is_packed(filename):
+        return load_compact_model(filename)
+
+    file_ext = os.path.splitext(filename)[1]
+    if file_ext != '.txt':
+        raise Exception('MODEL FILE IS NOT OF THE CORRECT FORMAT')
+
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except IOError:
+        raise Exception('CAN\'T FIND MODEL FILE')
@@ -1,79 +1,121 @@
 """
-Test an SVM on a polynomial-kernel transformed dataset.
+Test an SVM on a kernel transformed dataset.
 :authors Jason, Nick, Sam
 """
 
 import os
+import sys
 import argparse
-import glob
-import pickle
 
-from sk_train import poly_kernel, rep_data
+import numpy as np
+
+from card_cache import load_cards
+from kernel_matrix import rows_per_block
+from kernels import kernel_from_spec
+from svm_model import load_model, support_vectors
 
 
 testing_class = 'W'
 
+# Memory cap of one block of kernel values while scoring
+BLOCK_MB = 64
+
 def load_data(args):
     '''
-    Loads the trained model, training data and testing data, if they exist.
+    Loads the trained model and testing data, if they exist.
+
+    The model holds everything scoring needs, so the training data is not loaded.
 
     :param args: Command line arguments
     '''
 
-    # Load trained SVM model
-    model_file_name = args.model_file_name
+    # Load trained SVM model (compact or pickled)
+    model = load_model(args.model_file_name)
 
-    file_ext = os.path.splitext(model_file_name)[1]
-    if file_ext != '.txt':
-        raise Exception('MODEL FILE IS NOT OF THE CORRECT FORMAT')
+    # Load the test data
+    testing_data_path = os.path.join(os.getcwd(), args.test_folder_data)
 
-    try:
-        with open(model_file_name, 'rb') as f:
-            model = pickle.load(f)
-    except IOError:
-        raise Exception('CAN\'T FIND MODEL FILE')
+    if not os.path.exists(testing_data_path):
+        raise Exception('Testing data folder not found')
 
-    #################################################################
-    # Why is this here???
+    # Cards come sorted by index; I_plus holds the positions of the positive ones
+    testing_pixels, testing_labels, _ = load_cards(testing_data_path)
+    testing_data = testing_pixels / 255
+    class_letter = model.get('class_letter') or testing_class
+    I_plus = [str(k) for k, label in enumerate(testing_labels) if label == ord(class_letter)]
 
-    # Load the training data
-    training_data_path = os.path.join(os.getcwd(), args.train_folder_data)
+    if len(testing_data) < 1:
+        raise Exception('NO TESTING DATA')
+    print(I_plus)
+    return model, testing_data, I_plus, testing_labels
 
-    if not os.path.exists(training_data_path):
-        raise Exception('Training data folder not found')
 
-    training_data = []
-    for f_name in glob.glob(os.path.join(training_data_path, '*.png')):
-        x_train = rep_data(f_name)
-        training_data.append(x_train)
-        # to score... jason chee
+def decision_terms(p):
+    """
+    Gather what g(x) needs from a model: its support vectors, their signed
+    alphas, the constant term and the kernel. Worth keeping when scoring
+    many batches.
 
-    if not training_data:
-        raise Exception('NO TRAINING DATA')
-    #################################################################
+    :param p: Params for the trained model (alphas, X's, A~C, kernel)
+    :returns type tuple: (n_sv x 625) support vectors, signed alphas, (B - A)/2, Kernel
+    """
+    sv = support_vectors(p)
+    X_train = np.vstack((sv['X_plus'], sv['X_minus']))
+    coef = np.concatenate((sv['alpha_i'], -sv['alpha_j']))
 
-    # Load the test data
-    testing_data_path = os.path.join(os.getcwd(), args.test_folder_data)
+    # Models saved before the kernel was recorded used the default poly kernel
+    return X_train, coef, 0.5*(p['B'] - p['A']), kernel_from_spec(p.get('kernel'))
 
-    if not os.path.exists(testing_data_path):
-        raise Exception('Testing data folder not found')
 
-    testing_data = []
-    I_plus = []
-    for f_name in glob.glob(os.path.join(testing_data_path, '*.png')):
-        x_test = rep_data(f_name)
-        testing_data.append(x_test)
-        # to score... jason chee
-        f_name = os.path.splitext(os.path.basename(f_name))
+def score_batch(p, X, block_mb=BLOCK_MB, dtype=np.float64):
+    """
+    Computes g(x) from the lecture notes for a whole matrix of test vectors.
+
+    g(x) = sum_i alpha_i K(x_i, x) - sum_j alpha_j K(x_j, x) + (B - A)/2,
+    evaluated as blocked matrix products so that at most block_mb of kernel
+    values are held in memory at once. With float32, the kernel values are
+    float32 but g is still summed in float64.
+
+    :param p: Params for the trained model (alphas, X's, A~C), or its decision_terms
+    :param X: (n_test x 625) matrix of test vectors
+    :param block_mb: memory cap of one block of kernel values, in MB
+    :param dtype: precision of the kernel values, float64 or float32
+    :returns numpy array: g for every test vector
+    """
+    X = np.asarray(X, dtype=dtype)
+    X = X.reshape(len(X), -1)
 
-        ind, letter = f_name[0].split('_')
-        if letter.upper() == testing_class:
-            I_plus.append(ind)
+    X_train, coef, offset, kernel = p if isinstance(p, tuple) else decision_terms(p)
+    X_train = np.asarray(X_train, dtype=dtype)
+    coef = np.asarray(coef, dtype=np.float64)
 
-    if not testing_data:
-        raise Exception('NO TESTING DATA')
-    print I_plus
-    return model, testing_data, I_plus
+    block_rows = rows_per_block(X_train.shape[0] * X_train.itemsize, block_mb * 2**20)
+
+    g = np.empty(len(X), dtype=np.float64)
+    for start in range(0, len(X), block_rows):
+        stop = min(start + block_rows, len(X))
+        g[start:stop] = np.dot(kernel.matrix(X[start:stop], X_train), coef)
+
+    g += offset
+    return g
+
+
+def predict_multiclass(bundle, X, block_mb=BLOCK_MB, dtype=np.float64):
+    """
+    Classify test vectors with a one-vs-rest bundle: the class whose
+    classifier gives the largest g(x) wins.
+
+    :param bundle: the loaded bundle, {'classes': [letters], 'models': {letter: params}}
+    :param X: (n_test x 625) matrix of test vectors
+    :param block_mb: memory cap of one block of kernel values, in MB
+    :param dtype: precision of the kernel values, float64 or float32
+    :returns numpy array: ord() of the predicted letter of every test vector
+    """
+    classes = bundle['classes']
+    scores = np.array([score_batch(bundle['models'][letter], X, block_mb, dtype) for letter in classes])
+    letters = np.array([ord(letter) for letter in classes], dtype=np.uint8)
+
+    return letters[np.argmax(scores, axis=0)]
 
 
 def test_SVM(p, x):
@@ -85,29 +127,7 @@ def test_SVM(p, x):
     :param x: test vector
     :returns: True if g >= 0; otherwise, False
     """
-    
-    # Compare  to positive ex's alpha_i = p['alpha_i']
-    alpha_i = p['alpha_i']
-    X_plus = p['X_plus']
-
-    sum_plus = sum(
-        [ai*poly_kernel(xi, x) for ai, xi in zip(alpha_i, X_plus)]
-    )
-
-    # Compare to negative ex's
-    alpha_j = p['alpha_j']
-    X_minus = p['X_minus']
-
-    sum_minus = sum(
-        [-aj*poly_kernel(xj, x) for aj, xj in zip(alpha_j, X_minus)]
-    )
-
-    sum_total = sum_plus + sum_minus
-
-    A = p['A']
-    B = p['B']
-    g = sum_total + 0.5*(B - A)
-    print g
+    g = score_batch(p, [x])[0]
     return True if g >= 0 else False
 
 
@@ -125,7 +145,7 @@ parser.add_argument(
 
 parser.add_argument(
     'train_folder_data',
-    help='Path of the folder containing the training data.'
+    help='Path of the folder containing the training data (unused, the model is self-contained).'
 )
 
 parser.add_argument(
@@ -133,38 +153,64 @@ parser.add_argument(
     help='Path of the folder containing the testing data.'
 )
 
+parser.add_argument(
+    '--block-mb',
+    type=float,
+    default=BLOCK_MB,
+    help='Memory cap of one block of kernel values while scoring, in MB (default: {}).'.format(BLOCK_MB)
+)
+
+parser.add_argument(
+    '--dtype',
+    choices=('float64', 'float32'),
+    default='float64',
+    help='Precision of the kernel values while scoring (default: float64).'
+)
+
 if __name__ == '__main__':
     args = parser.parse_args()
 
     # Read inputs
-    model, testing_data, I_plus = load_data(args)
+    model, testing_data, I_plus, testing_labels = load_data(args)
+
+    # One-vs-rest bundle: argmax over the classifiers
+    if 'models' in model:
+        correct = predict_multiclass(model, testing_data, args.block_mb, args.dtype) == testing_labels
+        for letter in model['classes']:
+            is_letter = testing_labels == ord(letter)
+            print('{}: {}/{} correct'.format(letter, correct[is_letter].sum(), is_letter.sum()))
+        print('Fraction Correct: ' + str(correct.mean()))
+        sys.exit(0)
+
+    I_plus = set(I_plus)
 
     # Compare
     results = {'Correct': 0,
                'False Positive': 0,
                'False Negative': 0}
 
-    for i, input_test in enumerate(testing_data):
-        g = test_SVM(model, input_test)
+    decisions = score_batch(model, testing_data, args.block_mb, args.dtype) >= 0
+
+    for i, g in enumerate(decisions):
         if g:
             if str(i) in I_plus:
-                print str(i+1) + ' Correct'
+                print(str(i+1) + ' Correct')
                 results['Correct'] += 1
             else:
-                print str(i+1) + ' False Positive'
+                print(str(i+1) + ' False Positive')
                 results['False Positive'] += 1
         else:
             if str(i) not in I_plus:
-                print str(i+1) + ' Correct'
+                print(str(i+1) + ' Correct')
                 results['Correct'] += 1
             else:
-                print str(i) + ' False Negative'
+                print(str(i) + ' False Negative')
                 results['False Negative'] += 1
 
     # for debugging --
-    print 'Num Correct: ' + str(results['Correct'])
-    print 'num positives: ' + str(len(I_plus))
-    print 'out of: ' + str(len(testing_data))
+    print('Num Correct: ' + str(results['Correct']))
+    print('num positives: ' + str(len(I_plus)))
+    print('out of: ' + str(len(testing_data)))
     # ----------------
 
     for result in results:
@@ -172,8 +218,8 @@ if __name__ == '__main__':
 
 
 
-    print 'Fraction Correct: ' + str(results['Correct'])
-    print 'Fraction False Positive: ' + str(results['False Positive'])
-    print 'Fraction False Negative: ' + str(results['False Negative'])
+    print('Fraction Correct: ' + str(results['Correct']))
+    print('Fraction False Positive: ' + str(results['False Positive']))
+    print('Fraction False Negative: ' + str(results['False Negative']))
     # print 'Tests complete'
 
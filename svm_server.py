@@ -0,0 +1,361 @@
+"""
+Long-lived scoring service for trained S-K SVM models.
+
+Models are loaded once and kept warm. Requests from all clients are
+gathered into micro-batches and scored together.
+
+Endpoints:
+    GET  /models               names & classes of the loaded models
+    POST /score?model=NAME     body is either a .npy array of cards
+                               ((n x 625) or (n x 25 x 25), integer pixels 0-255 or
+                               floats already normalized to [0, 1]) or the
+                               bytes of one PNG card (Content-Type: image/png)
+
+Usage:
+    python svm_server.py w=w_model.zsvm ovr=ovr_model.zsvm [--port 8256 | --socket PATH]
+
+:authors Jason, Nick, Sam
+"""
+
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+from image_loader import CARD_PIXELS, CARD_SIZE
+from svm_model import load_model
+from svm_model_tester import BLOCK_MB, decision_terms, score_batch
+
+
+# Micro-batching defaults
+MAX_BATCH = 4096
+MAX_WAIT_MS = 5
+
+
+class MicroBatcher(object):
+    """
+    Scores the cards of concurrent requests together on one thread.
+
+    The first waiting request opens a batch; requests arriving within
+    max_wait_ms join it, up to max_batch cards.
+    """
+
+    def __init__(self, score_fn, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        """
+        :param score_fn: maps an (n x 625) matrix to a (k x n) matrix of decision values
+        :param max_batch: the most cards scored at once
+        :param max_wait_ms: how long a batch waits for more requests
+        """
+        self.score_fn = score_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, X):
+        """
+        :param X: (n x 625) matrix of cards
+        :returns type Future: resolves to the (k x n) decision values of the cards
+        """
+        future = Future()
+        self.queue.put((X, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            rows = len(batch[0][0])
+            deadline = time.time() + self.max_wait
+
+            while rows < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                rows += len(batch[-1][0])
+
+            try:
+                scores = self.score_fn(np.concatenate([X for X, _ in batch]))
+            except Exception:
+                # Score each request on its own, so only the bad ones fail
+                for X, future in batch:
+                    try:
+                        future.set_result(self.score_fn(X))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for X, future in batch:
+                future.set_result(scores[:, start:start + len(X)])
+                start += len(X)
+
+
+class WarmModel(object):
+    """
+    A loaded model (single class or one-vs-rest bundle) with its decision
+    terms ready in memory and its own micro-batcher.
+    """
+
+    def __init__(self, name, path, block_mb=BLOCK_MB, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS,
+                 dtype=np.float64):
+        model = load_model(path)
+
+        self.name = name
+        self.path = path
+        self.block_mb = block_mb
+        self.dtype = dtype
+
+        if 'models' in model:
+            self.classes = model['classes']
+            models = [model['models'][letter] for letter in self.classes]
+        else:
+            self.classes = [model.get('class_letter')]
+            models = [model]
+
+        # Support vectors cast to the scoring precision once, not per batch
+        self.terms = []
+        for params in models:
+            X_train, coef, offset, kernel = decision_terms(params)
+            self.terms.append((np.asarray(X_train, dtype=dtype), coef, offset, kernel))
+
+        self.batcher = MicroBatcher(self.score, max_batch, max_wait_ms)
+
+    @property
+    def is_bundle(self):
+        return len(self.terms) > 1
+
+    def score(self, X):
+        """
+        :param X: (n x 625) matrix of cards
+        :returns numpy array: (k x n) decision values, one row per class
+        """
+        return np.array([score_batch(terms, X, self.block_mb, self.dtype) for terms in self.terms])
+
+    def respond(self, X):
+        """
+        :param X: (n x 625) matrix of cards
+        :returns type dict: the JSON response for the cards
+        """
+        scores = self.batcher.submit(X).result()
+
+        if self.is_bundle:
+            return {
+                'model': self.name,
+                'predictions': [self.classes[k] for k in np.argmax(scores, axis=0)],
+                'g': {letter: row.tolist() for letter, row in zip(self.classes, scores)}
+            }
+
+        return {
+            'model': self.name,
+            'class_letter': self.classes[0],
+            'decisions': (scores[0] >= 0).tolist(),
+            'g': scores[0].tolist()
+        }
+
+
+def parse_cards(body, content_type):
+    """
+    :param body: the request body
+    :param content_type: the request Content-Type
+    :returns numpy array: (n x 625) matrix of cards normalized to [0, 1]; raises on any other shape
+    """
+    if content_type == 'image/png':
+        X = np.asarray(Image.open(io.BytesIO(body)).convert('L'))
+        if X.shape != CARD_SIZE:
+            raise Exception('a card is {}x{} pixels, not {}x{}'.format(*(CARD_SIZE + X.shape)))
+        X = X.reshape(1, -1)
+    else:
+        X = np.load(io.BytesIO(body), allow_pickle=False)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        elif X.ndim == 3 and X.shape[1:] == CARD_SIZE:
+            X = X.reshape(len(X), -1)
+        if X.ndim != 2 or X.shape[1] != CARD_PIXELS:
+            raise Exception('cards must be (n x {}) or (n x {} x {}), not {}'.format(
+                CARD_PIXELS, CARD_SIZE[0], CARD_SIZE[1], X.shape))
+
+    if np.issubdtype(X.dtype, np.integer):
+        # Pixels, of any integer dtype
+        if X.size and (X.min() < 0 or X.max() > 255):
+            raise Exception('integer pixels must be 0 to 255')
+        return X / 255
+    if not np.issubdtype(X.dtype, np.floating):
+        raise Exception('cards must be integer pixels or floats, not {}'.format(X.dtype))
+    return X.astype(np.float64)
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler over the server's warm models (see module docstring).
+    """
+
+    def address_string(self):
+        # UNIX socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/models':
+            return self._send_json(404, {'error': 'not found'})
+
+        self._send_json(200, {
+            name: {'path': model.path, 'classes': model.classes}
+            for name, model in self.server.models.items()
+        })
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/score':
+            return self._send_json(404, {'error': 'not found'})
+
+        models = self.server.models
+        name = parse_qs(url.query).get('model', [None])[0]
+        if name is None and len(models) == 1:
+            name = next(iter(models))
+        if name not in models:
+            return self._send_json(404, {'error': 'unknown model: {}'.format(name)})
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            X = parse_cards(body, self.headers.get('Content-Type', ''))
+        except Exception as e:
+            return self._send_json(400, {'error': 'bad cards: {}'.format(e)})
+
+        try:
+            self._send_json(200, models[name].respond(X))
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+
+class ThreadingTCPHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(models, port=None, socket_path=None, host='127.0.0.1', quiet=False):
+    """
+    :param models: dict of name -> WarmModel
+    :param port: local TCP port to listen on
+    :param socket_path: UNIX socket to listen on instead of a port
+    :param host: interface for the TCP port (local only by default)
+    :param quiet: if True, do not log every request
+    :returns: the (not yet serving) server
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, ScoringHandler)
+    else:
+        server = ThreadingTCPHTTPServer((host, port), ScoringHandler)
+
+    server.models = models
+    server.quiet = quiet
+    return server
+
+
+# CLARGS
+parser = argparse.ArgumentParser(
+    description='Serve trained SVM models from memory.',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog='For further questions, please consult the README.'
+)
+
+parser.add_argument(
+    'models',
+    nargs='+',
+    help='Models to serve, as NAME=PATH (or PATH, named after the file).'
+)
+parser.add_argument(
+    '--port',
+    type=int,
+    default=8256,
+    help='Local TCP port to listen on (default: 8256).'
+)
+parser.add_argument(
+    '--socket',
+    default=None,
+    help='Listen on this UNIX socket instead of a TCP port.'
+)
+parser.add_argument(
+    '--max-batch',
+    type=int,
+    default=MAX_BATCH,
+    help='Most cards scored together (default: {}).'.format(MAX_BATCH)
+)
+parser.add_argument(
+    '--max-wait-ms',
+    type=float,
+    default=MAX_WAIT_MS,
+    help='How long a batch waits for more requests (default: {}).'.format(MAX_WAIT_MS)
+)
+parser.add_argument(
+    '--block-mb',
+    type=float,
+    default=BLOCK_MB,
+    help='Memory cap of one block of kernel values, in MB (default: {}).'.format(BLOCK_MB)
+)
+parser.add_argument(
+    '--dtype',
+    choices=('float64', 'float32'),
+    default='float64',
+    help='Precision of the kernel values while scoring (default: float64).'
+)
+parser.add_argument(
+    '--quiet',
+    action='store_true',
+    default=False,
+    help='Do not log every request.'
+)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    models = {}
+    for spec in args.models:
+        name, _, path = spec.rpartition('=')
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        models[name] = WarmModel(name, path, args.block_mb, args.max_batch, args.max_wait_ms, args.dtype)
+        print('Loaded {} from {}'.format(name, path))
+
+    server = make_server(models, args.port, args.socket, quiet=args.quiet)
+    print('Serving on {}'.format(args.socket or 'http://127.0.0.1:{}'.format(args.port)))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,242 @@
+"""
+Instrumentation of S-K training runs.
+
+A TrainingMonitor keeps wall-clock totals per phase (loading, kernel
+matrix, init, should_stop, adapt, kernel rows, checkpoints), counts the
+kernel rows fetched, and traces m_delta and the memory high-water mark
+every N steps to a JSON lines file (or CSV, if the file ends in .csv).
+cProfile and tracemalloc can be switched on for the same run.
+
+Phases nest: the kernel row time of adapt is counted under both.
+
+:authors Jason, Nick, Sam
+"""
+
+import cProfile
+import csv
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+PHASES = ('load', 'kernel_matrix', 'init', 'should_stop', 'adapt', 'kernel_rows', 'checkpoint')
+
+# Columns of a trace line
+FIELDS = (
+    ['step', 'elapsed', 'm_delta', 'A', 'B', 'C', 'kernel_rows']
+    + ['{}_s'.format(name) for name in PHASES]
+    + ['max_rss_mb', 'traced_peak_mb']
+)
+
+
+def max_rss_mb():
+    """
+    :returns type float: the memory high-water mark of this process, in MB (None if unknown)
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def class_path(path, args, class_letter=None):
+    """
+    :param path: an output file of the run, or None
+    :param args: the CLARGS from user input
+    :param class_letter: the class being trained (one file per class with ALL)
+    :returns type str: the output file of the class
+    """
+    if path and class_letter is not None and args.class_letter.upper() == 'ALL':
+        root, ext = os.path.splitext(path)
+        path = '{}.{}{}'.format(root, class_letter, ext)
+    return path
+
+
+class CountingRows(object):
+    """
+    Wraps kernel rows (GramMatrix, ScaledGram, KernelRowCache) to count and
+    time every row fetched. Everything else is passed through.
+    """
+
+    def __init__(self, gram, monitor):
+        self.gram = gram
+        self.monitor = monitor
+
+    def row(self, k):
+        self.monitor.kernel_rows += 1
+        with self.monitor.phase('kernel_rows'):
+            return self.gram.row(k)
+
+    def __getattr__(self, name):
+        return getattr(self.gram, name)
+
+
+class TrainingMonitor(object):
+    """
+    Per-phase timers, kernel row counts and a convergence trace of one run.
+    """
+
+    def __init__(self, path=None, every=100, trace_memory=False, profile=None):
+        """
+        :param path: the trace file (.csv for CSV; otherwise JSON lines), None for no trace
+        :param every: trace every this many steps
+        :param trace_memory: if True, also trace the tracemalloc peak (slows training)
+        :param profile: if given, cProfile the run and write its stats to this file
+        """
+        self.path = path
+        self.every = max(1, every)
+        self.trace_memory = trace_memory
+        self.profile_path = profile
+
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.kernel_rows = 0
+        self.start = time.time()
+        self.steps = 0
+        self.last_m_delta = None
+
+        self.file = None
+        self.writer = None
+        if path is not None:
+            self.file = open(path, 'w')
+            if path.endswith('.csv'):
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(FIELDS)
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.profiler = None
+        if profile is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @classmethod
+    def from_args(cls, args, class_letter=None):
+        """
+        :param args: the CLARGS from user input
+        :param class_letter: the class being trained
+        :returns type TrainingMonitor: the monitor of the run
+        """
+        return cls(
+            class_path(getattr(args, 'metrics', None), args, class_letter),
+            getattr(args, 'metrics_every', 100),
+            getattr(args, 'trace_memory', False),
+            class_path(getattr(args, 'profile', None), args, class_letter)
+        )
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the body of a with block as the given phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def wrap(self, gram):
+        """
+        :param gram: kernel rows (see CountingRows)
+        :returns: the kernel rows, counted & timed
+        """
+        return CountingRows(gram, self)
+
+    def snapshot(self, step, state=None, m_delta=None):
+        """
+        :param step: the training step
+        :param state: the SKState, for A~C
+        :param m_delta: the stop condition value of the step
+        :returns type dict: the counters at this step
+        """
+        snap = {
+            'step': step,
+            'elapsed': time.time() - self.start,
+            'm_delta': m_delta,
+            'A': None if state is None else float(state.A),
+            'B': None if state is None else float(state.B),
+            'C': None if state is None else float(state.C),
+            'kernel_rows': self.kernel_rows
+        }
+        for name in PHASES:
+            snap['{}_s'.format(name)] = self.seconds[name]
+        snap['max_rss_mb'] = max_rss_mb()
+        snap['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2.0**20 if self.trace_memory else None
+
+        return snap
+
+    def step(self, step, state, m_delta):
+        """
+        Record one training step; traced every `every` steps.
+
+        :param step: the training step
+        :param state: the SKState
+        :param m_delta: the stop condition value of the step
+        """
+        self.steps = step + 1
+        self.last_m_delta = m_delta
+        if self.file is not None and step % self.every == 0:
+            self._write(self.snapshot(step, state, m_delta))
+
+    def _write(self, snap, event='step'):
+        if self.writer is not None:
+            if event == 'step':
+                self.writer.writerow([snap[key] for key in FIELDS])
+        else:
+            snap = dict(snap, event=event)
+            self.file.write(json.dumps(snap) + '\n')
+        self.file.flush()
+
+    def summary(self, state=None, gram=None):
+        """
+        :param state: the final SKState
+        :param gram: the kernel rows, for their cache statistics
+        :returns type dict: the totals of the run
+        """
+        snap = self.snapshot(self.steps, state, self.last_m_delta)
+        if gram is not None and hasattr(gram, 'stats'):
+            snap['kernel_cache'] = gram.stats
+        return snap
+
+    def report(self, summary):
+        """
+        :param summary: see summary
+        :returns type str: a one-line summary of where the time went
+        """
+        phases = ', '.join('{} {:.2f}s'.format(name, summary['{}_s'.format(name)])
+                           for name in PHASES if summary['{}_s'.format(name)])
+        line = 'Run: {} steps in {:.2f}s ({}); {} kernel rows'.format(
+            summary['step'], summary['elapsed'], phases, summary['kernel_rows'])
+        if summary['max_rss_mb'] is not None:
+            line += '; max RSS {:.1f} MB'.format(summary['max_rss_mb'])
+        return line
+
+    def close(self, state=None, gram=None):
+        """
+        Write the summary and profile, and close the trace file.
+
+        :param state: the final SKState
+        :param gram: the kernel rows, for their cache statistics
+        :returns type dict: the totals of the run (see summary)
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+
+        summary = self.summary(state, gram)
+        if self.file is not None:
+            self._write(summary, 'summary')
+            self.file.close()
+            self.file = None
+        if self.trace_memory:
+            tracemalloc.stop()
+
+        return summary
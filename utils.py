@@ -3,21 +3,25 @@ Utils module for handling data.
 
 :author Sam O
 """
-import glob
-import os
-
 import numpy as np
 from PIL import Image
 
+from card_cache import load_cards
+from image_loader import CARD_SIZE, read_image
+from zener_generator import generate_batch
+
 def init_data(args, as_PIL=False):
     """
     Initialize the preliminaries for S-K algo learning of SVM
 
+    Cards are read from the folder's card cache when it is up to date
+    (see card_cache.py), so no PNG has to be decoded.
+
     :param args: the CLARGS from user input
     :returns type dict: The dict of X's, I's, Y's (all +/-'s)
     """
 
-    img_dir = os.path.join(args.train_folder_name, '*.png')
+    pixels, labels, indices = load_input_cards(args)
 
     X_plus = []
     X_minus = []
@@ -26,18 +30,18 @@ def init_data(args, as_PIL=False):
     I_plus = []
     I_minus = []
 
-    for img_path in glob.glob(img_dir):
-        f_name = os.path.splitext(os.path.basename(img_path))
-        ind, letter = f_name[0].split('_')
+    class_label = ord(args.class_letter.upper())
+    for pixel_row, label, ind in zip(pixels, labels, indices):
+        x = to_PIL(pixel_row) if as_PIL else pixel_row / 255
 
-        if letter.upper() == args.class_letter.upper():
-            X_plus.append(rep_data(img_path, as_PIL))
-            Y_plus.append(ord(letter.upper()))
-            I_plus.append(ind)
+        if label == class_label:
+            X_plus.append(x)
+            Y_plus.append(int(label))
+            I_plus.append(str(ind))
         else:
-            X_minus.append(rep_data(img_path, as_PIL))
-            Y_minus.append(ord(letter.upper()))
-            I_minus.append(ind)
+            X_minus.append(x)
+            Y_minus.append(int(label))
+            I_minus.append(str(ind))
 
     if len(X_plus) < 1 or len(X_minus) < 1:
         raise Exception('NO DATA')
@@ -61,19 +65,42 @@ def init_data(args, as_PIL=False):
     return ret  # Vectors in X by class and index
 
 
-def rep_data(img_path, as_PIL=False):
+def load_input_cards(args):
     """
-    The contents of this image as a sequence object containing pixel values. The sequence object is flattened, so that values for line one follow directly after the values of line zero, and so on.
+    Load the training cards: generated in memory if args.generate is set,
+    otherwise read from args.train_folder_name (a folder or .npz shard).
+
+    :param args: the CLARGS from user input
+    :returns type tuple: pixels, labels & indices arrays sorted by index
+    """
+    if getattr(args, 'generate', None):
+        return generate_batch(args.generate, seed=getattr(args, 'generate_seed', None))
+
+    if not args.train_folder_name:
+        raise Exception('NO DATA')
+
+    return load_cards(args.train_folder_name)
 
-    Note that the sequence object returned by this method is an internal PIL data type, which only supports certain sequence operations. To convert it to an ordinary sequence (e.g. for printing), use list(im.getdata()).
+
+def to_PIL(pixel_row):
+    """
+    :param pixel_row: a flattened uint8 card, as stored in the card cache
+    :returns PIL image: the 25x25 greyscale card
+    """
+    return Image.fromarray(np.asarray(pixel_row, dtype=np.uint8).reshape(CARD_SIZE), 'L')
+
+
+def rep_data(img_path, as_PIL=False, dtype=np.float64):
+    """
+    The contents of this image as a flattened vector of greyscale pixel values, so that values for line one follow directly after the values of line zero, and so on.
+
+    The card is decoded straight into the vector (see image_loader.read_image); use image_loader.load_images to decode many cards into one matrix.
 
     :param img_path: the path to image file
+    :param dtype: dtype of the vector; float dtypes are normalized to 1's for white; 0's otherwise
     :returns numpy arrays: A vector representation of the image.
     """
-    img = Image.open(img_path)
     if as_PIL:
-        return img
-
-    arr = np.array(list(img.getdata()), int)
+        return Image.open(img_path)
 
-    return arr/255 # normalize to 1's for white; 0's otherwise
+    return read_image(img_path, dtype=dtype)
@@ -1,5 +1,5 @@
 '''
-Generate 25x25 Zener Cards as png files.
+Generate 25x25 Zener Cards as png files, a .npz shard, or in-memory arrays.
 
 :authors Jason, Nick, Sam
 '''
@@ -7,7 +7,9 @@ Generate 25x25 Zener Cards as png files.
 import os
 import argparse
 import random
+from multiprocessing import Pool
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageOps
 
 # Pos/neg in either direction
@@ -17,6 +19,29 @@ MAX_ROTATION = 180
 
 DRAW_NOISE = True
 
+SHAPES = ['O', 'P', 'Q', 'S', 'W']
+
+# Cards per RNG seed; chunks of this size are handed out to the workers
+CHUNK_SIZE = 1000
+
+# Inverted shape images, loaded once per process (see load_shapes)
+_shape_masks = {}
+
+def load_shapes():
+    '''
+    Load and invert every shape in zener_shapes/ into the per-process cache.
+    '''
+
+    for shape in SHAPES:
+        file_path = os.path.join(os.getcwd(), 'zener_shapes', shape + '.jpg')
+
+        try:
+            src = Image.open(file_path)
+        except IOError:
+            raise Exception('Shape not found')
+
+        _shape_masks[shape] = ImageOps.invert(src)
+
 def draw_shape(bg, shape, pos_offset=0, size_offset=0, rotation=0):
     '''
     Draw a Zener Card shape.
@@ -28,70 +53,231 @@ def draw_shape(bg, shape, pos_offset=0, size_offset=0, rotation=0):
     :param rotation: Amount to rotate shape
     '''
 
-    file_path = os.path.join(os.getcwd(), 'zener_shapes', shape + '.jpg')
+    if not _shape_masks:
+        load_shapes()
 
     try:
-        src = Image.open(file_path)
-    except IOError:
+        src = _shape_masks[shape]
+    except KeyError:
         raise Exception('Shape not found')
 
-    mask = ImageOps.invert(src).rotate(rotation).resize((bg.size[0] + size_offset, bg.size[1] + size_offset)).convert('1')
+    mask = src.rotate(rotation).resize((bg.size[0] + size_offset, bg.size[1] + size_offset)).convert('1')
 
     bg.paste(0, box=((bg.size[0] - mask.size[0]) // 2 + pos_offset, (bg.size[1] - mask.size[1]) // 2 + pos_offset), mask=mask)
 
-def draw_noise(im, density=0.02, iterations=50):
+def draw_noise(im, density=0.02, iterations=50, rng=random):
     '''
     Draws noise (ellipsoids) at random points on the image with a given probability.
 
     :param im: The image to draw the noise on
     :param density: The probability that an ellipsoid will be drawn
     :param iterations: The number of times to run the noise algorithm
+    :param rng: The random number generator to draw from
     '''
 
     draw = ImageDraw.Draw(im)
 
     for n in range(0, iterations):
-        if random.random() <= density:
-            x1 = random.randint(0, im.size[0])
-            y1 = random.randint(0, im.size[1])
+        if rng.random() <= density:
+            x1 = rng.randint(0, im.size[0])
+            y1 = rng.randint(0, im.size[1])
 
-            x2 = x1 + random.randint(1, 3)
-            y2 = y1 + random.randint(1, 3)
+            x2 = x1 + rng.randint(1, 3)
+            y2 = y1 + rng.randint(1, 3)
 
             draw.ellipse((x1, y1) + (x2, y2), fill=0, outline=0)
 
+def draw_card(rng):
+    '''
+    Draw a single random Zener Card.
+
+    :param rng: The random number generator to draw from
+    :returns: The 25x25 greyscale card and its shape
+    '''
+
+    card = Image.new('L', (25, 25), 255)
+
+    size_offset = rng.randint(-MAX_SIZE_OFFSET, MAX_SIZE_OFFSET)
+    pos_offset = rng.randint(-MAX_POS_OFFSET, MAX_POS_OFFSET)
+    rotation = rng.randint(-MAX_ROTATION, MAX_ROTATION)
+
+    shape = rng.choice(SHAPES)
+    draw_shape(card, shape, pos_offset=pos_offset, size_offset=size_offset, rotation=rotation)
+
+    if DRAW_NOISE and rng.randint(0, 1):
+        draw_noise(card, rng=rng)
+
+    return card, shape
+
+def chunk_rng(seed, chunk):
+    '''
+    The random number generator of one chunk of cards.
+
+    :param seed: The run seed, or None for a non-reproducible run
+    :param chunk: The chunk number
+    '''
+
+    if seed is None:
+        return random.Random()
+    return random.Random('{}:{}'.format(seed, chunk))
+
+def chunk_range(chunk, num_examples):
+    '''
+    :param chunk: The chunk number
+    :param num_examples: The total number of cards
+    :returns: The range of 0-based card numbers in the chunk
+    '''
+
+    return range(chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, num_examples))
+
+def generate_chunk(path, chunk, num_examples, seed):
+    '''
+    Generate and save the cards of one chunk, i.e. cards
+    chunk * CHUNK_SIZE + 1 to (chunk + 1) * CHUNK_SIZE.
+
+    :param path: The output folder
+    :param chunk: The chunk number
+    :param num_examples: The total number of cards
+    :param seed: The run seed, or None for a non-reproducible run
+    '''
+
+    rng = chunk_rng(seed, chunk)
+
+    for n in chunk_range(chunk, num_examples):
+        card, shape = draw_card(rng)
+
+        filename = '{}_{}.png'.format(n + 1, shape)
+        card.save(os.path.join(path, filename))
+
+def draw_chunk(chunk, num_examples, seed):
+    '''
+    Draw the cards of one chunk straight into arrays (same cards as generate_chunk).
+
+    :param chunk: The chunk number
+    :param num_examples: The total number of cards
+    :param seed: The run seed, or None for a non-reproducible run
+    :returns: (n x 625) uint8 pixels, ord() of the letters & 1-based card indices
+    '''
+
+    rng = chunk_rng(seed, chunk)
+    card_range = chunk_range(chunk, num_examples)
+
+    pixels = np.empty((len(card_range), 25 * 25), dtype=np.uint8)
+    labels = np.empty(len(card_range), dtype=np.uint8)
+    indices = np.arange(card_range.start + 1, card_range.stop + 1, dtype=np.int64)
+
+    for k in range(len(card_range)):
+        card, shape = draw_card(rng)
+        pixels[k] = np.asarray(card).reshape(-1)
+        labels[k] = ord(shape)
+
+    return pixels, labels, indices
+
+def _generate_chunk(job):
+    return generate_chunk(*job)
+
+def _draw_chunk(job):
+    return draw_chunk(*job)
+
+def map_chunks(func, jobs, workers=1):
+    '''
+    Run func over the chunk jobs, in order, across a pool of workers.
+
+    :param func: The function applied to each job
+    :param jobs: The list of job tuples
+    :param workers: The number of processes to use
+    '''
+
+    if workers > 1:
+        pool = Pool(workers, initializer=load_shapes)
+        try:
+            for result in pool.imap(func, jobs):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            yield func(job)
+
+def iter_card_batches(num_examples, seed=None, workers=1):
+    '''
+    Generate Zener Cards in memory, one chunk of CHUNK_SIZE cards at a time.
+
+    A seeded run yields the same cards generate_zener_cards writes to disk.
+
+    :param num_examples: The number of cards to generate
+    :param seed: The run seed, or None for a non-reproducible run
+    :param workers: The number of processes to generate with
+    :returns: An iterator of (pixels, labels, indices) batches, see draw_chunk
+    '''
+
+    num_chunks = (num_examples + CHUNK_SIZE - 1) // CHUNK_SIZE
+    jobs = [(chunk, num_examples, seed) for chunk in range(num_chunks)]
+
+    return map_chunks(_draw_chunk, jobs, workers)
+
+def generate_batch(num_examples, seed=None, workers=1):
+    '''
+    Generate Zener Cards in memory.
+
+    :param num_examples: The number of cards to generate
+    :param seed: The run seed, or None for a non-reproducible run
+    :param workers: The number of processes to generate with
+    :returns: (n x 625) uint8 pixels, ord() of the letters & 1-based card indices
+    '''
+
+    batches = list(iter_card_batches(num_examples, seed, workers))
+    if not batches:
+        return (np.empty((0, 25 * 25), dtype=np.uint8),
+                np.empty(0, dtype=np.uint8),
+                np.empty(0, dtype=np.int64))
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*batches))
+
+def save_shard(path, pixels, labels, indices):
+    '''
+    Save cards as a single .npz shard, readable by card_cache.load_cards.
+
+    :param path: The output file
+    '''
+
+    np.savez(path, pixels=pixels, labels=labels, indices=indices)
+
 def generate_zener_cards(args):
     '''
     Generate nny number of Zener Cards.
 
-    :param folder_name: The name of the output folder
+    The cards are split into chunks of CHUNK_SIZE, each with its own RNG
+    seeded from args.seed, so a seeded run gives the same cards whatever
+    the number of workers.
+
+    :param folder_name: The name of the output folder (or .npz shard)
     :param num_examples: The number of training examples to generate
+    :param workers: The number of processes to generate with
+    :param seed: The run seed, or None for a non-reproducible run
+    :param format: 'png' for one file per card, 'npz' for a single shard
     '''
 
     path = os.path.join(os.getcwd(), args.folder_name)
 
+    if args.format == 'npz':
+        if not path.endswith('.npz'):
+            path += '.npz'
+        save_shard(path, *generate_batch(args.num_examples, args.seed, args.workers))
+        return
+
     if not os.path.exists(path):
         os.mkdir(path)
     else:
         for filename in os.listdir(path):
             os.remove(os.path.join(path, filename))
 
-    shapes = ['O', 'P', 'Q', 'S', 'W']
-    for n in range(0, args.num_examples):
-        card = Image.new('L', (25, 25), 255)
-
-        size_offset = random.randint(-MAX_SIZE_OFFSET, MAX_SIZE_OFFSET)
-        pos_offset = random.randint(-MAX_POS_OFFSET, MAX_POS_OFFSET)
-        rotation = random.randint(-MAX_ROTATION, MAX_ROTATION)
+    num_chunks = (args.num_examples + CHUNK_SIZE - 1) // CHUNK_SIZE
+    jobs = [(path, chunk, args.num_examples, args.seed) for chunk in range(num_chunks)]
 
-        shape = random.choice(shapes)
-        draw_shape(card, shape, pos_offset=pos_offset, size_offset=size_offset, rotation=rotation)
-
-        if DRAW_NOISE and random.randint(0, 1):
-            draw_noise(card)
-
-        filename = '{}_{}.png'.format(n + 1, shape)
-        card.save(os.path.join(path, filename))
+    for _ in map_chunks(_generate_chunk, jobs, args.workers):
+        pass
 
 
 # CLARGS
@@ -103,13 +289,31 @@ parser = argparse.ArgumentParser(
 
 parser.add_argument(
     'folder_name',
-    help='The name of the output folder.'
+    help='The name of the output folder (or .npz shard with --format npz).'
 )
 parser.add_argument(
     'num_examples',
     help='The number of images to generate.',
     type=int
 )
+parser.add_argument(
+    '--workers',
+    help='The number of processes to generate with (default: 1).',
+    type=int,
+    default=1
+)
+parser.add_argument(
+    '--seed',
+    help='Seed for reproducible output (default: unseeded).',
+    type=int,
+    default=None
+)
+parser.add_argument(
+    '--format',
+    help='Write one png per card, or a single npz shard (default: png).',
+    choices=['png', 'npz'],
+    default='png'
+)
 
 
 if __name__ == '__main__':